@@ -1,26 +1,44 @@
+import voomerBot.startup as startup
 import logging
 import os
+import threading
 from pytz import timezone
 
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext
 from telegram import ParseMode
-from datetime import time, datetime
-from voomerBot.relocator import kicks_requirements, kicks_locations, kicks_relocation
-from voomerBot.vehiclesDumper import get_vehicles
-from voomerBot.vehicle_kicker import check_kicks
-from voomerBot.utils import distribution, distribution_points, zoho
-import pandas as pd
-from time import sleep
+from datetime import datetime, timedelta
+import voomerBot.metrics as metrics
+import voomerBot.outbox as outbox
+from voomerBot.commands import single_flight, offload
+import simplejson as json
+from concurrent.futures import ThreadPoolExecutor
 
 network_retries = int(os.environ.get('NETWORK_RETRIES', '5'))
 network_sleep = int(os.environ.get('NETWORK_SLEEP', '2'))
 timeout_connect = float(os.environ.get('TIMEOUT_CONNECT', '9.15'))
 timeout_read = float(os.environ.get('TIMEOUT_READ', '60'))
-CHAT_ID = int(os.environ.get('CHAT_ID'))
-CITY = os.environ.get('CITY')
+#envia los movimientos sugeridos por zona despues de la revision
+plan_moves = os.environ.get('PLAN_MOVES', '1') == '1'
+
+def _cities():
+    '''Cities run by this process, CITIES='{"bog": {"chat_id": 1, "interval": 30}, ...}'.
+    interval is in minutes, runs are aligned to the hour.
+    Falls back to a single CITY / CHAT_ID.'''
+    cities = json.loads(os.environ.get('CITIES', '{}'))
+    if len(cities) == 0:
+        cities = {os.environ.get('CITY'): {'chat_id': int(os.environ.get('CHAT_ID'))}}
+    for city, cfg in cities.items():
+        #una llave desconocida se ignoraria en silencio, p. ej. el viejo "minutes": [0, 30]
+        unknown = set(cfg) - {'chat_id', 'interval'}
+        if len(unknown) > 0:
+            logging.warning('CITIES[{}] ignores unknown keys {}, use "interval" in minutes'.format(city, sorted(unknown)))
+        cfg.setdefault('interval', 30)
+    return cities
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 
+CITIES = _cities()
+
 def start(update, context):
     context.bot.send_message(chat_id=update.message.chat_id, text="hola, soy un robot!", parse_mode=ParseMode.HTML)
 
@@ -30,23 +48,93 @@ def getid(update, context):
 def error(bot, update, error):
     logger.warning('Update "%s" caused error "%s"', update, error)
 
-def check(context):
+_warmed = []
+_warm_lock = threading.Lock()
+
+def warm_start():
+    '''Imports the pipeline and seeds the geo cache from the last stored run, once.'''
+    with _warm_lock:
+        if len(_warmed) > 0:
+            return
+        startup.warm()
+        snapshots = startup.load('voomerBot.snapshots')
+        relocator = startup.load('voomerBot.relocator')
+        for city in CITIES:
+            #un snapshot ilegible solo cuesta el arranque en caliente de esa ciudad
+            try:
+                snapshot = snapshots.latest(city)
+                if snapshot is not None:
+                    logging.info('Warm start for {} from snapshot taken at {}'.format(city, snapshot['taken_at']))
+                    relocator.seed_geo(snapshot['fleet'], snapshot['geo_key'])
+            except Exception as err:
+                logging.warning('Warm start for {} skipped {}'.format(city, err))
+        _warmed.append(True)
+        startup.report()
+
+def run_check(bot, city):
+    #las dependencias pesadas se cargan aqui y no al arrancar (STARTUP_WARM)
+    warm_start()
+    pipeline = startup.load('voomerBot.pipeline')
+    relocator = startup.load('voomerBot.relocator')
+    snapshots = startup.load('voomerBot.snapshots')
+    vehicle_kicker = startup.load('voomerBot.vehicle_kicker')
+    planner = startup.load('voomerBot.planner')
+
+    chat_id = CITIES[city]['chat_id']
     hora = datetime.now(timezone('America/Bogota')).strftime("%H:%M:%S")
-    context.bot.send_message(chat_id=CHAT_ID, text="Patinetas a revisar a las {}".format(hora))
-    dist = distribution(CITY) 
-    points = distribution_points(dist['points'])
-    kicks_zoho = zoho()
-    kicks = get_vehicles(CITY)
-    kicks_loc = kicks_locations(kicks, points, dist['map'], kicks_zoho)
-    checked_kicks = check_kicks(kicks_loc)
-
-    context.bot.send_message(chat_id=CHAT_ID, text=checked_kicks, timeout=15, parse_mode=ParseMode.HTML)
+    outbox.send(bot, chat_id, ["Patinetas a revisar a las {}".format(hora)])
+    with metrics.stage(city, 'total'):
+        with metrics.stage(city, 'fetch'):
+            sources = pipeline.fetch_sources(city)
+        dist, kicks_zoho, kicks = sources['distribution'], sources['zoho'], sources['vehicles']
+        if dist is None or kicks is None:
+            outbox.send(bot, chat_id, ["No se pudo cargar la distribución o las patinetas"])
+            return
+        with metrics.stage(city, 'locations'):
+            kicks_loc = relocator.kicks_locations(kicks, dist['starts'], dist['zones'], kicks_zoho)
+        with metrics.stage(city, 'snapshot'):
+            snapshots.save(city, kicks_loc, dist['points'], (dist['zones']['key'], dist['starts']['key']))
+        with metrics.stage(city, 'check_kicks'):
+            checked_kicks = vehicle_kicker.check_kicks(kicks_loc, city)
+        if kicks_zoho[0] == 203:
+            checked_kicks = '<i>Inventario de Zoho desactualizado</i>\n' + checked_kicks
+
+        outbox.send(bot, chat_id, [checked_kicks], timeout=15, parse_mode=ParseMode.HTML)
+
+        if plan_moves:
+            with metrics.stage(city, 'plan'):
+                moves = planner.plan(relocator.report_aggregate(kicks_loc, dist['points']))
+            if len(moves) > 0:
+                outbox.send(bot, chat_id, planner.moves_text(moves), timeout=15, parse_mode=ParseMode.HTML)
+
+def check(bot, city, scheduled=False):
+    #una sola revision por ciudad a la vez, las que llegan mientras corre se unen a ella
+    future, started = single_flight(city, run_check, bot, city)
+    if started:
+        return future.result()
+    if scheduled:
+        logging.info('Skipping scheduled check for {}, previous run still going'.format(city))
+    else:
+        outbox.send(bot, CITIES[city]['chat_id'], ["Ya hay una revisión en curso, el reporte llega al terminar"])
+
+def check_cities(bot, cities):
+    with ThreadPoolExecutor(max_workers=len(cities)) as pool:
+        for f in [pool.submit(check, bot, city) for city in cities]:
+            f.result()
 
 def user_check(update, context):
-    check(context)
+    #el chat revisa sus ciudades, un chat sin ciudad revisa todas
+    chat_id = update.message.chat_id
+    cities = [c for c, cfg in CITIES.items() if cfg['chat_id'] == chat_id]
+    cities = cities if len(cities) > 0 else list(CITIES)
+    #el trabajo pesado sale del hilo del dispatcher para no frenar otros comandos
+    if offload(check_cities, context.bot, cities) is None:
+        outbox.send(context.bot, chat_id, ["Hay demasiadas revisiones en cola, intenta en unos minutos"])
+    else:
+        outbox.send(context.bot, chat_id, ["Trabajando en eso..."])
 
 def programmed_check(context):
-    check(context)
+    check(context.bot, context.job.context, scheduled=True)
 
 if __name__ == "__main__":
     # Set these variable to the appropriate values
@@ -61,6 +149,10 @@ if __name__ == "__main__":
                         level=logging.INFO)
     logger = logging.getLogger(__name__)
 
+    # Warm start from the last stored run, before the webhook only in eager mode
+    if startup.warm_mode == 'eager':
+        warm_start()
+
     # Set up the Updater
     request_dict = {}
     request_dict['read_timeout'] = 7
@@ -76,37 +168,46 @@ if __name__ == "__main__":
     dispatcher.add_error_handler(error)
 
     j = updater.job_queue
-    for h in [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 23]:
-        for m in [0,30]:
-            j.run_daily(programmed_check, time(h,m,0), (0, 1, 2, 3, 4, 5, 6))
+    for city, cfg in CITIES.items():
+        #un solo trabajo repetido por ciudad, el primero alineado a la hora
+        now = datetime.now(timezone('America/Bogota'))
+        interval = timedelta(minutes=cfg['interval'])
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        first = midnight + ((now - midnight) // interval + 1) * interval
+        j.run_repeating(programmed_check, interval=interval, first=first, context=city)
 
     #updater.start_polling()
     updater.start_webhook(listen="0.0.0.0", port=int(PORT), url_path=TOKEN)
     updater.bot.setWebhook("https://{}.herokuapp.com/{}".format(NAME, TOKEN))
+    metrics.serve(updater)
+    metrics.WEBHOOK_READY_SECONDS.set(startup.elapsed())
+    logger.info('Webhook listening {:.3f}s after start'.format(startup.elapsed()))
+    if startup.warm_mode == 'background':
+        threading.Thread(target=warm_start, daemon=True, name='warm-start').start()
     #updater.idle()
 
 
     """
-def reloc(context): 
+def reloc(bot, city):
+    chat_id = CITIES[city]['chat_id']
     hora = datetime.now(timezone('America/Bogota')).strftime("%H:%M:%S")
-    print(CHAT_ID)
-    context.bot.send_message(chat_id=CHAT_ID, text="Patinetas por punto a las {}".format(hora))
+    outbox.send(bot, chat_id, ["Patinetas por punto a las {}".format(hora)])
 
-    dist = distribution(CITY) 
-    points = distribution_points(dist['points'])
-    kicks_zoho = zoho()
-    kicks = get_vehicles(CITY)
-    kicks_loc = kicks_locations(kicks, points, dist['map'], kicks_zoho)
-    relocation_msg = kicks_relocation(kicks_loc, dist['points'])
+    warm_start()
+    pipeline = startup.load('voomerBot.pipeline')
+    relocator = startup.load('voomerBot.relocator')
+    sources = pipeline.fetch_sources(city)
+    dist, kicks_zoho, kicks = sources['distribution'], sources['zoho'], sources['vehicles']
+    kicks_loc = relocator.kicks_locations(kicks, dist['starts'], dist['zones'], kicks_zoho)
+    relocation_msg = relocator.kicks_relocation(kicks_loc, dist['points'])
 
-    for msg in relocation_msg:
-        context.bot.send_message(chat_id=CHAT_ID, text=msg, timeout=15, parse_mode=ParseMode.HTML)
-        sleep(10)
+    outbox.send(bot, chat_id, relocation_msg, timeout=15, parse_mode=ParseMode.HTML)
 
 def user_reloc(update, context):
-    reloc(context)
+    for city in CITIES:
+        reloc(context.bot, city)
 
 def programmed_reloc(context):
-    reloc(context)
+    reloc(context.bot, context.job.context)
 
 """
\ No newline at end of file
@@ -0,0 +1,98 @@
+'''Local stand-ins for the 2hire, Zoho, Sheets and Drive endpoints used by the
+pipeline. They run in a child process so their allocations do not count
+against the stages being measured.'''
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import multiprocessing
+import simplejson as json
+import re
+import socket
+import time
+
+
+def _col(letters):
+    n = 0
+    for ch in letters:
+        n = n * 26 + ord(ch) - ord('A') + 1
+    return n - 1
+
+
+def a1_slice(rows, a1):
+    '''Values of an A1 range such as 'E12' or 'T14:AF' over get_all_values rows,
+    with trailing empty cells trimmed like the Sheets API does.'''
+    cells = re.findall(r'([A-Z]+)(\d*)', a1)
+    (c0, r0), (c1, r1) = cells[0], cells[-1]
+    r0 = int(r0) - 1 if r0 else 0
+    r1 = int(r1) if r1 else len(rows)
+    values = []
+    for row in rows[r0:r1]:
+        block = row[_col(c0):_col(c1) + 1]
+        while block and block[-1] == '':
+            block = block[:-1]
+        values.append(block)
+    while values and not values[-1]:
+        values.pop()
+    return values
+
+
+def _handler(data, latency):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.path.startswith('/v4/admin/login'):
+                return self._send(200, {'data': {'token': {'code': 'bench'}}})
+            self._send(404, {'error': 'not found'})
+
+        def do_GET(self):
+            time.sleep(latency)
+            url = urlparse(self.path)
+            q = parse_qs(url.query)
+            if url.path == '/v4/admin/api/sharing/vehicle/':
+                offset, limit = int(q['offset'][0]), int(q['limit'][0])
+                return self._send(200, {'data': {'data': data['vehicles'][offset:offset + limit]}})
+            if url.path.startswith('/v4/admin/api/maintenance/'):
+                return self._send(200, {'status': True})
+            if url.path.startswith('/api/json/'):
+                return self._send(200, {'Inv_Scan_Scooter': data['zoho']})
+            if url.path.startswith('/drive/v3/files/'):
+                return self._send(200, {'modifiedTime': '2020-01-01T00:00:00.000Z'})
+            if url.path.endswith('/values:batchGet'):
+                return self._send(200, {'valueRanges': [{'range': r, 'values': a1_slice(data['sheet'], r)}
+                                                        for r in q['ranges']]})
+            self._send(404, {'error': 'not found'})
+
+    return Handler
+
+
+def _serve(data, port, latency):
+    ThreadingHTTPServer(('127.0.0.1', port), _handler(data, latency)).serve_forever()
+
+
+def start(data, latency=0.0):
+    '''Starts the fake upstreams for a synthetic dataset.
+    Returns (base url, process); terminate the process when done.'''
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    proc = multiprocessing.Process(target=_serve, args=(data, port, latency), daemon=True)
+    proc.start()
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return 'http://127.0.0.1:{}'.format(port), proc
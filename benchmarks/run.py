@@ -0,0 +1,138 @@
+'''Per-stage wall time and peak memory of the check pipeline against
+synthetic data served by local fake upstreams. The 'check' rows time
+fetch_sources + kicks_locations + check_kicks in one go, as run_check
+does; cold drops every process cache first, warm reuses them.
+
+    python -m benchmarks.run --sizes 1000 10000 100000
+'''
+from benchmarks import synthetic, fakes
+from time import perf_counter
+from urllib.parse import urlparse
+import argparse
+import os
+import resource
+import tracemalloc
+
+
+def _environment(base):
+    #la configuracion se lee al importar voomerBot, por eso va antes
+    os.environ.update({'API_URL': base, 'ZOHO_URL': base, 'ZOHO_APP_NAME': 'bench',
+                       'ZOHO_VIEW_NAME': 'bench', 'ZOHO_CREDENTIALS': '{}',
+                       'NETWORK_RETRIES': '1', 'SNAPSHOT_DB': '', 'SERVICEID': 'bench',
+                       'CREDENTIALS': '{"user": "bench", "password": "bench"}',
+                       'MOVO_CREDENTIALS': '{"user": "bench", "password": "bench"}',
+                       #sin el limite de comandos de produccion, el servidor es local
+                       'ACTION_RATE': '1000000', 'ACTION_BURST': '1000000'})
+
+
+class _Worksheet:
+    '''Sheets values API client for the fake server, same batch_get as gspread.'''
+    def __init__(self, base):
+        self.url = base + '/v4/spreadsheets/bench/values:batchGet'
+
+    def batch_get(self, ranges):
+        import requests
+        r = requests.get(self.url, params={'ranges': ranges})
+        return [v.get('values', []) for v in r.json()['valueRanges']]
+
+
+class _Spreadsheet:
+    '''Stands in for the gspread Spreadsheet that distribution() opens, so the
+    revision check and the values fetch go to the fake server. Only the
+    service account login and gc.open are skipped.'''
+    id = 'bench'
+
+    def __init__(self, base):
+        self.base = base
+        self.client = self
+
+    def request(self, method, url, params=None):
+        import requests
+        return requests.request(method, self.base + urlparse(url).path, params=params)
+
+    def worksheet(self, name):
+        return _Worksheet(self.base)
+
+
+def _cold(city, base):
+    '''Drops the process caches so the next check fetches and parses everything.'''
+    from voomerBot import utils, session, relocator, vehicle_kicker
+    utils._sheets[city] = {'sheet': _Spreadsheet(base), 'revision': None, 'checked': float('-inf'), 'data': None}
+    utils._distributions.clear()
+    utils._zoho_cache.update({'data': None, 'fetched': 0, 'failed': False, 'refreshing': False})
+    session._tokens.clear()
+    relocator._geo_snapshots.clear()
+    vehicle_kicker._health.clear()
+    vehicle_kicker._free_before.clear()
+
+
+def _measure(results, stage, fn, *args):
+    tracemalloc.start()
+    start = perf_counter()
+    out = fn(*args)
+    elapsed = perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    results.append((stage, elapsed, peak))
+    return out
+
+
+def bench(vehicles, latency, seed=0, city='bog'):
+    data = synthetic.dataset(vehicles, seed)
+    base, proc = fakes.start(data, latency)
+    _environment(base)
+
+    from voomerBot import httpmodel, utils, relocator, planner, pipeline, vehicle_kicker
+    from voomerBot.vehiclesDumper import get_vehicles
+    httpmodel.api_url = base
+
+    results = []
+    try:
+        def locations(kicks):
+            return relocator.kicks_locations(kicks.copy(), dist['starts'], dist['zones'], kicks_zoho)
+
+        def check():
+            #el mismo camino de run_check: fuentes en paralelo, enriquecimiento y barrido
+            sources = pipeline.fetch_sources(city)
+            dist, kicks_zoho = sources['distribution'], sources['zoho']
+            kicks_loc = relocator.kicks_locations(sources['vehicles'], dist['starts'], dist['zones'], kicks_zoho)
+            return vehicle_kicker.check_kicks(kicks_loc, city)
+
+        _cold(city, base)
+        dist = _measure(results, 'distribution', utils.distribution, city)
+        kicks_zoho = _measure(results, 'zoho', utils.zoho)
+        kicks = _measure(results, 'get_vehicles', get_vehicles, city)
+        kicks_loc = _measure(results, 'kicks_locations cold', locations, kicks)
+        _measure(results, 'kicks_locations warm', locations, kicks)
+        _measure(results, 'kicks_requirements', relocator.kicks_requirements, kicks_loc, dist['points'])
+        _measure(results, 'kicks_relocation', relocator.kicks_relocation, kicks_loc, dist['points'])
+        aggregate = relocator.report_aggregate(kicks_loc, dist['points'])
+        _measure(results, 'plan moves', planner.plan, aggregate)
+        free = ((kicks_loc['zoho'] == 'Punto') & (kicks_loc['ops_status'] == 'free')).sum()
+        _measure(results, 'check_kicks ({} kicks)'.format(free), vehicle_kicker.check_kicks, kicks_loc, city)
+
+        _cold(city, base)
+        _measure(results, 'check cold (measured)', check)
+        _measure(results, 'check warm (measured)', check)
+    finally:
+        proc.terminate()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every fake GET')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print('{:>8} {:<28} {:>10} {:>12}'.format('vehicles', 'stage', 'wall s', 'peak MiB'))
+    for n in args.sizes:
+        for stage, elapsed, peak in bench(n, args.latency, args.seed):
+            print('{:>8} {:<28} {:>10.3f} {:>12.1f}'.format(n, stage, elapsed, peak / 2**20))
+    print('max RSS {:.1f} MiB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+'''Synthetic fleets, distribution sheets and KML zones for the benchmarks.
+Everything is generated from a seed so runs are comparable.'''
+import numpy as np
+from datetime import datetime, timedelta, timezone
+
+#caja de Bogota donde se generan zonas, puntos y patinetas
+bbox = {'lat': (4.55, 4.75), 'lng': (-74.15, -74.03)}
+
+kml_template = '''<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2"><Document>{}</Document></kml>'''
+
+placemark_template = '''<Placemark><name>{}</name><Polygon><outerBoundaryIs><LinearRing>
+<coordinates>{}</coordinates></LinearRing></outerBoundaryIs></Polygon></Placemark>'''
+
+
+def sizes_for(vehicles):
+    '''Number of distribution points and zones for a fleet size.'''
+    points = max(20, vehicles // 50)
+    zones = max(4, int(np.sqrt(points)))
+    return points, zones
+
+
+def zones(n):
+    '''Grid of n rectangular zones over bbox.
+    Returns [(name, letter, number, (lat0, lat1, lng0, lng1))]'''
+    cols = int(np.ceil(np.sqrt(n)))
+    rows = int(np.ceil(n / cols))
+    lat_edges = np.linspace(*bbox['lat'], rows + 1)
+    lng_edges = np.linspace(*bbox['lng'], cols + 1)
+    out = []
+    for i in range(n):
+        r, c = divmod(i, cols)
+        letter, number = chr(ord('A') + r % 26), str(c + 1)
+        out.append(('Zona ' + letter + number, letter, number,
+                    (lat_edges[r], lat_edges[r + 1], lng_edges[c], lng_edges[c + 1])))
+    return out
+
+
+def kml(zone_list):
+    marks = []
+    for name, _, _, (lat0, lat1, lng0, lng1) in zone_list:
+        ring = [(lng0, lat0), (lng1, lat0), (lng1, lat1), (lng0, lat1), (lng0, lat0)]
+        marks.append(placemark_template.format(name, ' '.join('{},{},0'.format(x, y) for x, y in ring)))
+    return kml_template.format(''.join(marks))
+
+
+def sheet(n_points, zone_list, rng):
+    '''Rows laid out like get_all_values on the distribution worksheet:
+    KML at [11][4], points from row 13 with the priority block at 19 and
+    the demand block at 43.'''
+    width = 56
+    rows = [[''] * width for _ in range(13)]
+    rows[11][4] = kml(zone_list)
+    points = []
+    for i in range(n_points):
+        name, letter, number, (lat0, lat1, lng0, lng1) = zone_list[i % len(zone_list)]
+        lat, lng = rng.uniform(lat0, lat1), rng.uniform(lng0, lng1)
+        row = [''] * width
+        row[0], row[1], row[2] = str(i + 1), letter + 'x', number
+        row[4], row[5], row[6] = 'Punto {}'.format(i), '{:.6f}'.format(lat), '{:.6f}'.format(lng)
+        for k in range(13):
+            row[19 + k] = str(rng.integers(1, 4))
+            row[43 + k] = str(rng.integers(0, 8))
+        rows.append(row)
+        points.append((lat, lng))
+    return rows, np.array(points)
+
+
+def fleet(n, points, rng, near_point=0.6):
+    '''2hire vehicle items; a share of them parked within ~30 m of a point.'''
+    now = datetime.now(timezone.utc)
+    near = rng.random(n) < near_point
+    idx = rng.integers(0, len(points), n)
+    lat = np.where(near, points[idx, 0] + rng.normal(0, 0.0002, n), rng.uniform(*bbox['lat'], n))
+    lng = np.where(near, points[idx, 1] + rng.normal(0, 0.0002, n), rng.uniform(*bbox['lng'], n))
+    trip_status = rng.integers(1, 5, n)
+    statuses = np.array(['free', 'running', 'unavailable'])[rng.integers(0, 3, n)]
+
+    items = []
+    for i in range(n):
+        booked = now - timedelta(minutes=int(rng.integers(1, 5000)))
+        items.append({
+            'id': i + 1,
+            'latitude': float(lat[i]),
+            'longitude': float(lng[i]),
+            'reference_code': 'VB{:07d}'.format(i + 1),
+            'status': str(statuses[i]),
+            'total_percentage': int(rng.integers(0, 101)),
+            'trip_status': int(trip_status[i]),
+            'deviceType': 'kick',
+            'created_at': '2020-01-01T00:00:00.000Z',
+            'updated_at': now.isoformat(),
+            'online': bool(rng.random() < 0.95),
+            'bookings': [{'id': 10 * (i + 1), 'status': int(rng.integers(0, 3)), 'type': 'standard',
+                          'created_at': booked.isoformat(), 'user': {'id': int(rng.integers(1, 10**6))}}]
+                        if rng.random() < 0.8 else [],
+            'battery': {'voltage': 36.5, 'cells': [3.6] * 10},
+        })
+    return items
+
+
+def zoho_inventory(items, rng, in_point=0.7):
+    '''Zoho Inv_Scan_Scooter rows, keyed by the QR (reference_code without prefix).'''
+    locations = np.array(['Punto', 'Bodega', 'Taller'])
+    return [{'QRScooter': v['reference_code'][2:],
+             'Ubicacion': 'Punto' if rng.random() < in_point else str(locations[rng.integers(1, 3)]),
+             'Estado': 'Activo'} for v in items]
+
+
+def dataset(vehicles, seed=0):
+    rng = np.random.default_rng(seed)
+    n_points, n_zones = sizes_for(vehicles)
+    zone_list = zones(n_zones)
+    rows, points = sheet(n_points, zone_list, rng)
+    items = fleet(vehicles, points, rng)
+    return {'sheet': rows, 'vehicles': items, 'zoho': zoho_inventory(items, rng)}
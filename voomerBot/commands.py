@@ -0,0 +1,52 @@
+from concurrent.futures import ThreadPoolExecutor, Future
+import threading
+import logging
+import os
+
+#solo libreria estandar, app.py lo usa en el hilo del dispatcher sin cargar el pipeline
+#comandos pesados de telegram: hilos que los ejecutan y cuantos pueden esperar en cola
+command_workers = int(os.environ.get('COMMAND_WORKERS', '2'))
+command_queue = int(os.environ.get('COMMAND_QUEUE', '4'))
+
+_command_executor = ThreadPoolExecutor(max_workers=command_workers, thread_name_prefix='command')
+_command_slots = threading.BoundedSemaphore(command_workers + command_queue)
+
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def single_flight(key, fn, *args):
+    '''Runs fn(*args) in the calling thread unless a call with the same key
+    is still running. Returns (future, started); callers that did not start
+    the call get the future of the one in flight.'''
+    with _inflight_lock:
+        future = _inflight.get(key)
+        if future is not None:
+            return future, False
+        future = Future()
+        _inflight[key] = future
+
+    try:
+        future.set_result(fn(*args))
+    except (Exception, SystemExit) as err:
+        future.set_exception(err)
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+    return future, True
+
+
+def offload(fn, *args):
+    '''Runs fn(*args) on the bounded command pool, out of the dispatcher
+    thread. Returns the future, or None when the pool and its queue are full.'''
+    if not _command_slots.acquire(blocking=False):
+        return None
+
+    def done(future):
+        _command_slots.release()
+        if future.exception() is not None:
+            logging.error('Command {} failed: {}'.format(getattr(fn, '__name__', fn), future.exception()))
+
+    future = _command_executor.submit(fn, *args)
+    future.add_done_callback(done)
+    return future
@@ -9,21 +9,67 @@ from time import sleep
 import logging
 import asyncio
 import aiohttp
+import io
+import random
+from voomerBot.ratelimit import TokenBucket
+from voomerBot.metrics import ERROR_IJSON, PAGES_FETCHED, RETRIES, upstream, _get_type
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from array import array
 
 network_retries = int(environ.get('NETWORK_RETRIES', '5'))
 network_sleep = int(environ.get('NETWORK_SLEEP', '2'))
 domain = environ.get('DOMAIN')
+#raiz de la api de 2hire, se puede apuntar a un servidor local para benchmarks
+api_url = environ.get('API_URL', 'https://{}'.format(domain))
 serviceid = environ.get('SERVICEID')
 page_step = int(environ.get('PAGE_STEP', '5000'))
+#paginas pedidas por adelantado mientras se parsea la actual, 0 las pide una a una
+page_prefetch = int(environ.get('PAGE_PREFETCH', '0'))
 timeout_connect = float(environ.get('TIMEOUT_CONNECT', '9.15'))
 timeout_read = float(environ.get('TIMEOUT_READ', '180'))
 
+#comandos masivos: maximo en vuelo y comandos por segundo hacia 2hire
+action_concurrency = int(environ.get('ACTION_CONCURRENCY', '20'))
+action_rate = float(environ.get('ACTION_RATE', '10'))
+_action_bucket = TokenBucket(action_rate, float(environ.get('ACTION_BURST', '20')))
+
+#conexiones keep-alive por host y numero de hosts con pool propio
+http_pool_size = int(environ.get('HTTP_POOL_SIZE', '10'))
+http_pool_hosts = int(environ.get('HTTP_POOL_HOSTS', '4'))
+
 http = urllib3.PoolManager(maxsize=50, cert_reqs='CERT_REQUIRED', ca_certs=certifi.where())
 
+#cliente compartido para las consultas sincronas, pool_block limita las conexiones por host
+client = requests.Session()
+_adapter = requests.adapters.HTTPAdapter(pool_connections=http_pool_hosts,
+                                         pool_maxsize=http_pool_size, pool_block=True)
+client.mount('https://', _adapter)
+client.mount('http://', _adapter)
+
+class StreamError(Exception):
+    '''A page of a streamed query could not be read after every retry,
+    the items already yielded are an incomplete listing.'''
+
+def connection_stats():
+    '''Connection counters of the shared pools, per host.
+    Returns {pool: {host: {'requests', 'new', 'reused'}}}'''
+    stats = {}
+    for name, manager in [('sync', _adapter.poolmanager), ('stream', http)]:
+        stats[name] = {}
+        for key in manager.pools.keys():
+            pool = manager.pools.get(key)
+            if pool is None:
+                continue
+            stats[name]['{}:{}'.format(pool.host, pool.port)] = {
+                'requests': pool.num_requests,
+                'new': pool.num_connections,
+                'reused': pool.num_requests - pool.num_connections}
+    return stats
+
 def _make_headers(token=None, serviceid=serviceid):
     headers = {'Content-Type': 'application/json; charset=utf-8',
             'X-SERVICE-TOKEN': serviceid,
-            'Connection':'close',
             'Accept-Encoding': 'gzip,deflate'}
     if token is not None:
         headers.update({'Authorization': 'Bearer %s' %(token)})
@@ -35,7 +81,9 @@ def _get_query(url, token, payload=None):
     Retries queries using exponential backoff'''
     for i in range(network_retries):
         try:
-            r = requests.get(url, params=payload, timeout=(timeout_connect, timeout_read), headers=_make_headers(token))
+            with upstream('2hire', _get_type(url)) as call:
+                r = client.get(url, params=payload, timeout=(timeout_connect, timeout_read), headers=_make_headers(token))
+                call['status'] = r.status_code
             j = r.json()
 
             if r.status_code == 200:
@@ -49,14 +97,19 @@ def _get_query(url, token, payload=None):
                 UnicodeEncodeError, JSONDecodeError) as err:
             logging.warning('GET query error {}'.format(url))
             if i != network_retries-1:
+                RETRIES.labels('2hire', _get_type(url)).inc()
                 sleep(network_sleep**i)
     return [500, ['Internal Error']]
 
 
-def _stream_query(url, token, filter=None):
+def _stream_query(url, token, filter=None, parser=None):
     '''Generator, yields first the HTTP status code and then the rest of the
     response payload. If the servers returns an HTTP error code the entire
-    reponse is yielled at the second call.'''
+    reponse is yielled at the second call.
+    parser(stream) turns each page into items, ijson items by default.'''
+    if parser is None:
+        parser = lambda stream: ijson.items(stream, 'data.data.item')
+
     def _safe_next_item(iterator):
         '''Get next iterator element, safe enclosure'''
         while True:
@@ -82,26 +135,86 @@ def _stream_query(url, token, filter=None):
                               'order':'[["id","ASC"]]'}
                     if filter is not None:
                         params.update(filter)
-                    yield http.request('GET', url, fields=params,
-                            timeout=urllib3.Timeout(connect=timeout_connect, read=timeout_read),
-                            headers=_make_headers(token),
-                            preload_content=False)
-                    index += 1
+                    with upstream('2hire', _get_type(url)) as call:
+                        response = http.request('GET', url, fields=params,
+                                timeout=urllib3.Timeout(connect=timeout_connect, read=timeout_read),
+                                headers=_make_headers(token),
+                                preload_content=False)
+                        call['status'] = response.status
+                    break
                 except (Exception) as e:
                     # Exceptions to set, don't kill me, I accept suggestions
                     logging.error('Chunked query error')
                     if i != network_retries-1:
+                        RETRIES.labels('2hire', _get_type(url)).inc()
                         sleep(network_sleep**i)
-
-    cq = _chunked_query(page_step, filter)
+            else:
+                #se agotaron los reintentos, el stream se corta
+                return
+            PAGES_FETCHED.labels(_get_type(url)).inc()
+            yield response
+            index += 1
+
+    def _fetch_page(index, step, filter):
+        '''Downloads a whole page, retrying with exponential backoff.
+        Returns None if every retry failed.'''
+        params = {'offset':index*step, 'limit':step,
+                  'order':'[["id","ASC"]]'}
+        if filter is not None:
+            params.update(filter)
+        for i in range(network_retries):
+            try:
+                with upstream('2hire', _get_type(url)) as call:
+                    response = http.request('GET', url, fields=params,
+                            timeout=urllib3.Timeout(connect=timeout_connect, read=timeout_read),
+                            headers=_make_headers(token))
+                    call['status'] = response.status
+                PAGES_FETCHED.labels(_get_type(url)).inc()
+                return response
+            except (Exception) as e:
+                logging.error('Prefetched query error')
+                if i != network_retries-1:
+                    RETRIES.labels('2hire', _get_type(url)).inc()
+                    sleep(network_sleep**i)
+
+    def _prefetched_query(step, filter, depth):
+        '''Generator, returns preloaded HTTP responses of each page in order.
+        Keeps up to depth pages in flight on the shared PoolManager, pages
+        past the end come back short and are never consumed.'''
+        pool = ThreadPoolExecutor(max_workers=depth)
+        pending = deque(pool.submit(_fetch_page, index, step, filter) for index in range(depth))
+        index = depth
+        try:
+            while True:
+                response = pending.popleft().result()
+                if response is None:
+                    return
+                pending.append(pool.submit(_fetch_page, index, step, filter))
+                index += 1
+                yield response
+        finally:
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=False)
+
+    if page_prefetch > 0:
+        cq = _prefetched_query(page_step, filter, page_prefetch)
+    else:
+        cq = _chunked_query(page_step, filter)
     response = _safe_next_item(cq)
+    if response is None:
+        #ni la primera pagina se pudo descargar
+        yield 503
+        yield 'Page fetch failed'
+        return
     yield response.status
 
     if response.status == 200:
         page = 0
         while response is not None:
             if response.status == 200:
-                iterator = ijson.items(response, 'data.data.item')
+                stream = io.BytesIO(response.data) if page_prefetch > 0 else response
+                iterator = parser(stream)
                 response = None
                 index = 0
                 try:
@@ -111,25 +224,27 @@ def _stream_query(url, token, filter=None):
                     if index == page_step:
                         response = _safe_next_item(cq)
                         page +=1
+                        if response is None:
+                            raise StreamError('page {} fetch failed'.format(page))
                 except (ConnectionResetError, urllib3.exceptions.ProtocolError) as e:
                     logging.error('Connection reset error')
-                    yield
+                    raise StreamError('page {} connection reset'.format(page))
                 except (urllib3.exceptions.ReadTimeoutError) as e:
                     logging.error('Connection read timeout error')
-                    yield
+                    raise StreamError('page {} read timeout'.format(page))
                 except(ijson.common.IncompleteJSONError,  urllib3.exceptions.IncompleteRead):
+                    ERROR_IJSON.labels(_get_type(url)).inc()
                     logging.warning('Iterator error')
-                    yield
+                    raise StreamError('page {} incomplete'.format(page))
             else:
-                response = None
-                yield
+                raise StreamError('page {} status {}'.format(page, response.status))
     else:
         yield response.data
 
-def _get_streamed_query(url, token, payload=None):
+def _get_streamed_query(url, token, payload=None, parser=None):
     '''Streamed HTTP query, requieres url and OAuth token.
     Returns [HTTP Status, initialized StreamIO].'''
-    sq = _stream_query(url, token, payload)
+    sq = _stream_query(url, token, payload, parser)
     status_code = next(sq, 0)
     try:
         if status_code == 200:
@@ -146,7 +261,9 @@ def _post_query(url, token=None, payload=None):
     Retries queries using exponential backoff'''
     for i in range(network_retries):
         try:
-            r = requests.post(url, json=payload, timeout=(timeout_connect, timeout_read), headers=_make_headers(token))
+            with upstream('2hire', _get_type(url)) as call:
+                r = client.post(url, json=payload, timeout=(timeout_connect, timeout_read), headers=_make_headers(token))
+                call['status'] = r.status_code
             j = r.json()
 
             if r.status_code == 200:
@@ -160,6 +277,7 @@ def _post_query(url, token=None, payload=None):
                 UnicodeEncodeError, JSONDecodeError) as err:
             logging.warning('POST query error {}'.format(url))
             if i != network_retries-1:
+                RETRIES.labels('2hire', _get_type(url)).inc()
                 sleep(network_sleep**i)
     return [500, ['Internal Error']]
 
@@ -169,7 +287,9 @@ def _put_query(url, token=None, payload=None):
     Retries queries using exponential backoff'''
     for i in range(network_retries):
         try:
-            r = requests.put(url, json=payload, timeout=(timeout_connect, timeout_read), headers=_make_headers(token))
+            with upstream('2hire', _get_type(url)) as call:
+                r = client.put(url, json=payload, timeout=(timeout_connect, timeout_read), headers=_make_headers(token))
+                call['status'] = r.status_code
             j = r.json()
 
             if r.status_code == 200:
@@ -183,41 +303,91 @@ def _put_query(url, token=None, payload=None):
                 UnicodeEncodeError, JSONDecodeError) as err:
             logging.warning('PUT query error {}'.format(url))
             if i != network_retries-1:
+                RETRIES.labels('2hire', _get_type(url)).inc()
                 sleep(network_sleep**i)
     return [500, ['Internal Error']]
 
 
 def login(user, password):
-    r = _post_query('https://{}/v4/admin/login'.format(domain), payload={'username': user, 'password': password})
+    r = _post_query('{}/v4/admin/login'.format(api_url), payload={'username': user, 'password': password})
     if r[0] == 200:
         return [200, r[1]['token']['code']]
     else:
         return r
 
 
-def vehicle(token, region=None):
-    '''Fetch vehicles list'''
-    def vehicle_filter(v):
-        bookings = v.get('bookings')
-        if isinstance(bookings, list):
-            booking = dict([(x,bookings[0].get(x))
-                        for x in ['id', 'status', 'type', 'created_at']] +
-                    [('UserId', bookings[0].get('user', {}).get('id'))]) if len(bookings) > 0 else None
-        else:
-            booking = None
+#columnas del listado de vehiculos, con su tipo de buffer (None guarda objetos)
+vehicle_fields = {'id': 'q', 'latitude': 'd', 'longitude': 'd', 'reference_code': None,
+    'status': None, 'total_percentage': 'd', 'trip_status': 'd', 'deviceType': None,
+    'created_at': None, 'updated_at': None, 'booking_id': 'd', 'booking_status': 'd',
+    'booking_type': None, 'booking_UserId': 'd', 'booking_created_at': None, 'online': 'd'}
+
+def _to_float(x):
+    try:
+        return float(x)
+    except (TypeError, ValueError):
+        return float('nan')
+
+#backend de ijson mas rapido disponible, el de C si esta compilado
+for _backend in ['yajl2_c', 'yajl2_cffi', 'yajl2', 'python']:
+    try:
+        ijson_backend = ijson.get_backend(_backend)
+        break
+    except Exception:
+        continue
+
+#prefijo del evento de ijson -> posicion en el registro plano de vehicle_fields
+_vehicle_slots = dict([('data.data.item.' + k, i) for i, k in enumerate(vehicle_fields)
+                       if not k.startswith('booking_')] +
+                      [('data.data.item.bookings.item.' + b, list(vehicle_fields).index(k))
+                       for k, b in [('booking_id', 'id'), ('booking_status', 'status'), ('booking_type', 'type'),
+                                    ('booking_created_at', 'created_at'), ('booking_UserId', 'user.id')]])
+_scalar_events = {'string', 'number', 'boolean', 'null'}
+
+def _vehicle_records(stream):
+    '''Generator, projects each vehicle of a page straight from the ijson
+    event stream into a flat list ordered as vehicle_fields. Only the first
+    booking is read, nothing else of the vehicle is materialized.'''
+    record = None
+    booking = -1
+    for prefix, event, value in ijson_backend.parse(stream, use_float=True):
+        if event in _scalar_events:
+            slot = _vehicle_slots.get(prefix)
+            if slot is not None and (booking <= 0 or not prefix.startswith('data.data.item.bookings.')):
+                record[slot] = value
+        elif prefix == 'data.data.item.bookings.item' and event == 'start_map':
+            booking += 1
+        elif prefix == 'data.data.item':
+            if event == 'start_map':
+                record = [None] * len(vehicle_fields)
+                booking = -1
+            elif event == 'end_map':
+                yield record
+
+def vehicle_columns(token, region=None):
+    '''Fetch vehicles list straight into typed column buffers.
+    Returns [200, {column: array or list}]'''
+    columns = {k: array(t) if t is not None else [] for k, t in vehicle_fields.items()}
+    casts = {k: {'q': int, 'd': _to_float}.get(t, lambda x: x) for k, t in vehicle_fields.items()}
+    buffers = [(columns[k], casts[k]) for k in vehicle_fields]
 
-        return dict([(i, v.get(i))
-                    for i in ['id', 'latitude', 'longitude', 'reference_code',
-                        'status', 'total_percentage', 'trip_status', 'deviceType',
-                        'created_at', 'updated_at', 'online']] +
-                        [('booking', booking)])
     payload = dict((k,v) for k,v in (('site',region),) if v is not None)
-    r = _get_streamed_query('https://{}/v4/admin/api/sharing/vehicle/'.format(domain), token, payload)
-    if r[0] == 200:
-        return [200, (vehicle_filter(v) for v in r[1])]
-    else:
+    r = _get_streamed_query('{}/v4/admin/api/sharing/vehicle/'.format(api_url), token, payload, _vehicle_records)
+    if r[0] != 200:
         return r
 
+    try:
+        for record in r[1]:
+            if record is None:
+                continue
+            for (column, cast), value in zip(buffers, record):
+                column.append(cast(value))
+    except StreamError as err:
+        #un listado incompleto sacaria patinetas de los reportes, se reporta como error
+        logging.error('Vehicle stream cut {}'.format(err))
+        return [503, [str(err)]]
+    return [200, columns]
+
 async def action(token, user_action, id, siteid, device = None):
     api = 'maintenance/sharing/'
     def get_cmd(user_action, device):
@@ -263,15 +433,32 @@ async def action(token, user_action, id, siteid, device = None):
 
 
 
-async def fetch_action(id, url, session, params, timeout):
-    try:
-        async with session.get(url) as resp:
-            j = await resp.json()
-            return [id, resp.status, j]
-    except (aiohttp.ClientConnectionError, UnicodeEncodeError, JSONDecodeError) as err:
-        print(err, flush=True)
-
-async def action2(token, user_action, ids, siteid, device = None):
+async def fetch_action(id, url, session, params, timeout, semaphore, bucket):
+    '''Runs one vehicle command, retrying with jittered exponential backoff.
+    Returns {'id', 'status', 'rsp', 'attempts'}'''
+    status, rsp = 599, {'status': False, 'error': {'type': 'connection error'}}
+    for i in range(network_retries):
+        async with semaphore:
+            await asyncio.sleep(bucket.reserve())
+            try:
+                with upstream('2hire', 'action') as call:
+                    async with session.get(url, params=params, timeout=timeout) as resp:
+                        call['status'] = resp.status
+                        status, rsp = resp.status, await resp.json(content_type=None)
+                if status < 500 and status != 429:
+                    return {'id': id, 'status': status, 'rsp': rsp, 'attempts': i + 1}
+            except (aiohttp.ClientError, asyncio.TimeoutError, UnicodeEncodeError, ValueError) as err:
+                logging.warning('Action error {} {}'.format(id, err))
+                status, rsp = 599, {'status': False, 'error': {'type': type(err).__name__}}
+        if i != network_retries-1:
+            RETRIES.labels('2hire', 'action').inc()
+            await asyncio.sleep(random.uniform(0, network_sleep**i))
+    return {'id': id, 'status': status, 'rsp': rsp, 'attempts': network_retries}
+
+async def action_stream(token, user_action, ids, siteid, device = None):
+    '''Async generator, runs user_action over every id with at most
+    ACTION_CONCURRENCY commands in flight and ACTION_RATE commands per
+    second. Yields one result per id as soon as it finishes.'''
     api = 'maintenance/sharing/'
     def get_cmd(user_action, device):
         return {
@@ -286,18 +473,25 @@ async def action2(token, user_action, ids, siteid, device = None):
     params = {k:v for k,v in {'site':siteid}.items() if v is not None}
     timeout = aiohttp.ClientTimeout(total=5*60, connect=timeout_connect, sock_connect=None, sock_read=None)
 
-    tasks = []
-
-    cmd = get_cmd(user_action, device) 
-    async with aiohttp.ClientSession(headers=_make_headers(token)) as session:
+    cmd = get_cmd(user_action, device)
+    if cmd is None:
         for id in ids:
-            url = 'domain' %(cmd[1], id, cmd[2]) 
-            task = asyncio.ensure_future(fetch_action(id, url, session, params, timeout))
-            tasks.append(task)
-
-        responses = await asyncio.gather(*tasks)
-         
-        return responses
-
+            yield {'id': id, 'status': 404, 'rsp': {'status': False, 'error': {'type': 'Command not found'}}, 'attempts': 0}
+        return
+
+    semaphore = asyncio.Semaphore(action_concurrency)
+    connector = aiohttp.TCPConnector(limit=action_concurrency)
+    async with aiohttp.ClientSession(headers=_make_headers(token), connector=connector) as session:
+        tasks = [asyncio.ensure_future(fetch_action(id,
+                    '{}/v4/admin/api/{}/{}/{}'.format(api_url, cmd[1], id, cmd[2]),
+                    session, params, timeout, semaphore, _action_bucket)) for id in ids]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
 
-  
\ No newline at end of file
+async def action2(token, user_action, ids, siteid, device = None):
+    '''Runs user_action over every id, returns the list of results'''
+    return [r async for r in action_stream(token, user_action, ids, siteid, device)]
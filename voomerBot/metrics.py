@@ -0,0 +1,74 @@
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, start_http_server, CONTENT_TYPE_LATEST
+from contextlib import contextmanager
+from urllib.parse import urlparse
+from time import monotonic
+from os import environ
+import logging
+
+#puerto propio para /metrics, si no se define se sirve en el mismo servidor del webhook
+metrics_port = environ.get('METRICS_PORT')
+
+UPSTREAM_REQUESTS = Counter('voomer_upstream_requests_total', 'Upstream calls by service, type and status',
+                            ['service', 'type', 'status'])
+UPSTREAM_SECONDS = Histogram('voomer_upstream_seconds', 'Upstream call duration', ['service', 'type'],
+                             buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 180))
+RETRIES = Counter('voomer_upstream_retries_total', 'Upstream calls retried after an error', ['service', 'type'])
+PAGES_FETCHED = Counter('voomer_pages_fetched_total', 'Streamed pages fetched', ['type'])
+ERROR_IJSON = Counter('voomer_ijson_errors_total', 'Errors while iterating a streamed response', ['type'])
+STAGE_SECONDS = Histogram('voomer_check_stage_seconds', 'Duration of each check stage', ['city', 'stage'],
+                          buckets=(.1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+IMPORT_SECONDS = Gauge('voomer_startup_import_seconds', 'Import time of each heavy module', ['module'])
+WEBHOOK_READY_SECONDS = Gauge('voomer_startup_webhook_seconds', 'Seconds from process start to webhook listening')
+
+
+def _get_type(url):
+    '''2hire object type of an API url, e.g. vehicle, login or action'''
+    path = [p for p in urlparse(url).path.split('/') if p]
+    if 'login' in path:
+        return 'login'
+    if 'maintenance' in path:
+        return 'action'
+    return path[-1] if len(path) > 0 else 'unknown'
+
+
+@contextmanager
+def upstream(service, kind):
+    '''Times an upstream call. Set call['status'] inside the block,
+    calls that raise are counted with status error.'''
+    call = {'status': 'error'}
+    start = monotonic()
+    try:
+        yield call
+    finally:
+        UPSTREAM_SECONDS.labels(service, kind).observe(monotonic() - start)
+        UPSTREAM_REQUESTS.labels(service, kind, str(call['status'])).inc()
+
+
+@contextmanager
+def stage(city, name):
+    '''Times a stage of the check pipeline.'''
+    start = monotonic()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(city, name).observe(monotonic() - start)
+
+
+def serve(updater=None):
+    '''Exposes /metrics on METRICS_PORT, or next to the webhook of updater
+    when no port is configured.'''
+    if metrics_port:
+        start_http_server(int(metrics_port))
+        return
+    try:
+        from tornado.web import RequestHandler
+
+        class MetricsHandler(RequestHandler):
+            def get(self):
+                self.set_header('Content-Type', CONTENT_TYPE_LATEST)
+                self.write(generate_latest())
+
+        app = updater.httpd.http_server.request_callback
+        app.add_handlers(r'.*', [(r'/metrics', MetricsHandler)])
+    except (AttributeError, ImportError) as err:
+        logging.warning('Metrics endpoint not available {}'.format(err))
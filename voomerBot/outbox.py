@@ -0,0 +1,112 @@
+from voomerBot.ratelimit import TokenBucket
+from voomerBot.metrics import RETRIES, upstream
+from telegram.error import BadRequest, RetryAfter, TimedOut, NetworkError
+from concurrent.futures import Future
+from os import environ
+from time import sleep
+import threading
+import logging
+import queue
+
+message_limit = 4096
+network_retries = int(environ.get('NETWORK_RETRIES', '5'))
+network_sleep = int(environ.get('NETWORK_SLEEP', '2'))
+#limites de telegram: ~1 mensaje/s por chat (20/min en grupos) y 30 mensajes/s en total
+chat_rate = float(environ.get('TELEGRAM_CHAT_RATE', '0.33'))
+chat_burst = float(environ.get('TELEGRAM_CHAT_BURST', '3'))
+global_rate = float(environ.get('TELEGRAM_GLOBAL_RATE', '30'))
+
+_global_bucket = TokenBucket(global_rate)
+_outboxes = {}
+_lock = threading.Lock()
+
+
+def _split(block, limit):
+    '''Splits a block longer than limit on line breaks, hard cutting lines
+    that alone are longer than limit.'''
+    parts, current = [], ''
+    for line in block.split('\n'):
+        while len(line) > limit:
+            if current:
+                parts.append(current)
+                current = ''
+            parts.append(line[:limit])
+            line = line[limit:]
+        if current and len(current) + 1 + len(line) > limit:
+            parts.append(current)
+            current = line
+        else:
+            current = current + '\n' + line if current else line
+    if current:
+        parts.append(current)
+    return parts
+
+
+def pack(blocks, limit=message_limit):
+    '''Joins text blocks, in order, into as few messages of at most limit
+    characters as possible. Empty blocks are dropped.'''
+    messages, current = [], ''
+    for block in blocks:
+        for part in _split(block.strip('\n'), limit):
+            if current and len(current) + 2 + len(part) > limit:
+                messages.append(current)
+                current = part
+            else:
+                current = current + '\n\n' + part if current else part
+    if current:
+        messages.append(current)
+    return messages
+
+
+def _deliver(bot, chat_id, text, kwargs):
+    for i in range(network_retries):
+        try:
+            with upstream('telegram', 'sendMessage') as call:
+                bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                call['status'] = 200
+            return
+        except BadRequest:
+            #en PTB 13 BadRequest hereda de NetworkError, pero es permanente y no se reintenta
+            raise
+        except RetryAfter as err:
+            logging.warning('Telegram flood control, retrying in {}s'.format(err.retry_after))
+            if i == network_retries-1:
+                raise
+            RETRIES.labels('telegram', 'sendMessage').inc()
+            sleep(err.retry_after)
+        except (TimedOut, NetworkError) as err:
+            logging.warning('Telegram send error {}'.format(err))
+            if i == network_retries-1:
+                raise
+            RETRIES.labels('telegram', 'sendMessage').inc()
+            sleep(network_sleep**i)
+
+
+def _worker(bot, chat_id, q):
+    bucket = TokenBucket(chat_rate, chat_burst)
+    while True:
+        messages, kwargs, future = q.get()
+        try:
+            for text in messages:
+                #se espera el token del chat y el global, sin pausas fijas
+                sleep(max(bucket.reserve(), _global_bucket.reserve()))
+                _deliver(bot, chat_id, text, kwargs)
+            future.set_result(len(messages))
+        except Exception as err:
+            logging.error('Telegram message to {} not sent {}'.format(chat_id, err))
+            future.set_exception(err)
+
+
+def send(bot, chat_id, blocks, **kwargs):
+    '''Queues blocks for chat_id packed into as few messages as possible.
+    Messages of a chat go out in order from its own sender thread.
+    Returns a Future with the number of messages sent.'''
+    with _lock:
+        if chat_id not in _outboxes:
+            q = queue.Queue()
+            threading.Thread(target=_worker, args=(bot, chat_id, q), daemon=True,
+                             name='outbox-{}'.format(chat_id)).start()
+            _outboxes[chat_id] = q
+    future = Future()
+    _outboxes[chat_id].put((pack(blocks), kwargs, future))
+    return future
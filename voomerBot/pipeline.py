@@ -0,0 +1,53 @@
+from voomerBot.utils import distribution, zoho
+from voomerBot.vehiclesDumper import get_vehicles
+from voomerBot.httpmodel import connection_stats
+from voomerBot.metrics import stage
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from time import monotonic
+import logging
+import os
+
+#tiempo maximo en segundos que se espera a cada fuente
+timeouts = {
+    'distribution': float(os.environ.get('TIMEOUT_DISTRIBUTION', '120')),
+    'zoho': float(os.environ.get('TIMEOUT_ZOHO', '60')),
+    'vehicles': float(os.environ.get('TIMEOUT_VEHICLES', '300')),
+}
+
+_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('FETCH_WORKERS', '6')),
+                               thread_name_prefix='fetch')
+
+
+def fetch_sources(city):
+    '''Loads the distribution sheet, the Zoho inventory and the vehicles
+    of city concurrently. Returns a dict with one entry per source, None
+    for the sources that failed or ran out of time.'''
+    def timed(name, fn, *args):
+        with stage(city, name):
+            return fn(*args)
+
+    futures = {
+        'distribution': _executor.submit(timed, 'distribution', distribution, city),
+        'zoho': _executor.submit(timed, 'zoho', zoho),
+        'vehicles': _executor.submit(timed, 'vehicles', get_vehicles, city),
+    }
+
+    start = monotonic()
+    sources = {}
+    for name, future in futures.items():
+        #los plazos corren desde el inicio, no se suman entre fuentes
+        remaining = max(0, timeouts[name] - (monotonic() - start))
+        try:
+            sources[name] = future.result(timeout=remaining)
+        except TimeoutError:
+            logging.error('{} fetch timed out for {}'.format(name, city))
+            sources[name] = None
+        except (Exception, SystemExit) as err:
+            logging.error('{} fetch failed for {}: {}'.format(name, city, err))
+            sources[name] = None
+
+    logging.info('HTTP connections {}'.format(connection_stats()))
+    if sources['zoho'] is None:
+        sources['zoho'] = [500, ['Internal Error']]
+    return sources
+
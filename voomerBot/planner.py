@@ -0,0 +1,99 @@
+from voomerBot.utils import haversine
+from scipy.optimize import linear_sum_assignment
+import numpy as np
+import pandas as pd
+import logging
+import os
+
+#distancia maxima en metros de un movimiento, mas lejos no se propone
+max_move = float(os.environ.get('PLAN_MAX_MOVE', '5000'))
+#patinetas candidatas que entran al solver, las mas cercanas a un faltante
+max_candidates = int(os.environ.get('PLAN_MAX_CANDIDATES', '2000'))
+#patinetas por bloque al buscar las candidatas, acota la memoria de la matriz de distancias
+chunk = 4096
+#solo se mueven patinetas que nadie esta usando
+movable = ['free', 'parked']
+
+move_columns = ['reference_code', 'origen', 'zona_origen', 'punto', 'zona', 'distance']
+
+
+def deficits(points):
+    '''Points missing active kicks, with how many they lack in 'faltan'.'''
+    deficit = (points['req'].fillna(0).astype(int) - points['activas'].astype(int)).clip(lower=0)
+    return points[deficit > 0].assign(faltan=deficit[deficit > 0])
+
+
+def candidates(points, active):
+    '''Kicks that can be moved: every active kick on the street plus, at
+    points with surplus, as many as the surplus, fullest battery first.'''
+    kicks = active[active['ops_status'].isin(movable)]
+    street = kicks[kicks['punto'] == 'en calle']
+
+    surplus = (points['activas'].astype(int) - points['req'].fillna(0).astype(int)).clip(lower=0)
+    surplus = surplus[surplus > 0].droplevel('zona')
+    surplus = surplus[~surplus.index.duplicated()]
+    at_points = kicks[kicks['punto'].isin(surplus.index)].sort_values('total_percentage', ascending=False)
+    rank = at_points.groupby('punto', observed=True).cumcount().to_numpy()
+    limit = surplus.reindex(at_points['punto'].astype(object)).to_numpy()
+    return pd.concat([street, at_points[rank < limit]])
+
+
+def plan(aggregate):
+    '''Minimum total distance moves from candidates to missing kicks.
+    aggregate es el resultado de report_aggregate.
+    Returns a dataframe with move_columns, one row per kick to move.'''
+    points = aggregate['points']
+    targets = deficits(points)
+    kicks = candidates(points, aggregate['active'])
+    if len(targets) == 0 or len(kicks) == 0:
+        return pd.DataFrame(columns=move_columns)
+
+    plat = targets['lat'].to_numpy(dtype=np.float64)[None, :]
+    plng = targets['lng'].to_numpy(dtype=np.float64)[None, :]
+
+    def distances(lat, lng):
+        #patinetas x puntos con faltante, no x cada patineta faltante
+        return haversine(lat[:, None], lng[:, None], plat, plng)
+
+    lat = kicks['latitude'].to_numpy(dtype=np.float64)
+    lng = kicks['longitude'].to_numpy(dtype=np.float64)
+
+    #con flotas grandes solo entran las patinetas mas cercanas a algun faltante
+    limit = max(max_candidates, int(targets['faltan'].sum()))
+    if len(kicks) > limit:
+        nearest = np.concatenate([distances(lat[i:i + chunk], lng[i:i + chunk]).min(axis=1)
+                                  for i in range(0, len(kicks), chunk)])
+        keep = np.sort(np.argpartition(nearest, limit)[:limit])
+        kicks, lat, lng = kicks.iloc[keep], lat[keep], lng[keep]
+
+    #una columna por patineta faltante, solo para las candidatas elegidas
+    slot_point = np.repeat(np.arange(len(targets)), targets['faltan'].to_numpy())
+    cost = distances(lat, lng)[:, slot_point]
+
+    #los movimientos demasiado largos se penalizan y se descartan despues
+    far = cost > max_move
+    cost[far] = max_move * 10
+    rows, cols = linear_sum_assignment(cost)
+    ok = ~far[rows, cols]
+    rows, cols = rows[ok], cols[ok]
+
+    moves = pd.DataFrame({
+        'reference_code': kicks['reference_code'].astype(object).to_numpy()[rows],
+        'origen': kicks['punto'].astype(object).to_numpy()[rows],
+        'zona_origen': kicks['zona'].astype(object).to_numpy()[rows],
+        'punto': targets.index.get_level_values('punto').to_numpy()[slot_point[cols]],
+        'zona': targets.index.get_level_values('zona').to_numpy()[slot_point[cols]],
+        'distance': cost[rows, cols],
+    })
+    logging.info('Planned {} moves for {} missing kicks from {} candidates'.format(len(moves), len(slot_point), len(kicks)))
+    return moves.sort_values(['zona', 'punto', 'distance'])[move_columns]
+
+
+def moves_text(moves):
+    '''Move list per destination zone, one text block per crew.'''
+    msg = []
+    for zone, df in moves.groupby('zona', sort=True):
+        lines = ['{0} {1} ➡️ <b>{2}</b> ({3:.0f} m)'.format(r['reference_code'], r['origen'], r['punto'], r['distance'])
+                 for r in df.to_dict('records')]
+        msg.append('<b>🚚 Movimientos en {0}: {1}</b>\n'.format(zone, len(df)) + '\n'.join(lines))
+    return msg
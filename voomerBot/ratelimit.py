@@ -0,0 +1,28 @@
+from time import monotonic
+import threading
+
+
+class TokenBucket:
+    '''Token bucket shared by threads and coroutines.
+    reserve() takes a token right away and returns the seconds the caller
+    has to wait before using it, so it works with time.sleep and
+    asyncio.sleep alike. A rate of 0 or less disables the limit.'''
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst) if burst is not None else max(1.0, self.rate)
+        self._tokens = self.burst
+        self._stamp = monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, n=1):
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= n
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
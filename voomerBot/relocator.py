@@ -1,16 +1,86 @@
-from voomerBot.vehiclesDumper import get_vehicles
-from voomerBot.utils import kmlparser, get_zone, get_start, zoho
+from voomerBot.utils import get_zones, get_starts, haversine
 import numpy as np
 import pandas as pd
 import os
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-from datetime import time, datetime
+from datetime import datetime
 import pytz
+import logging
+import threading
+
+#metros que se puede mover una patineta sin recalcular su zona y punto
+geo_tolerance = float(os.environ.get('GEO_TOLERANCE', '5'))
+
+#ultimo enriquecimiento por huella de kml y puntos, guarda la coordenada usada para calcularlo
+_geo_snapshots = {}
+_geo_lock = threading.Lock()
+geo_columns = ['latitude', 'longitude', 'zona', 'punto', 'distance', 'pointType']
+
+def geo_enrichment(kicks_df, points_list, zones):
+    """
+    devuelve zona, punto, distancia y tipo de punto por patineta
+    solo recalcula las patinetas que se movieron mas de geo_tolerance desde la corrida anterior
+    el cache se invalida cuando cambia el kml o los puntos de distribucion
+    """
+    key = (zones['key'], points_list['key'])
+    lat = kicks_df['latitude'].to_numpy(dtype=np.float64)
+    lng = kicks_df['longitude'].to_numpy(dtype=np.float64)
+
+    with _geo_lock:
+        previous = _geo_snapshots.get(key)
+    if previous is not None:
+        geo = previous.reindex(kicks_df.index)
+        moved = ~(haversine(lat, lng, geo['latitude'], geo['longitude']) <= geo_tolerance)
+    else:
+        geo = pd.DataFrame(index=kicks_df.index, columns=geo_columns)
+        moved = np.ones(len(kicks_df), dtype=bool)
+
+    if moved.any():
+        geo.loc[moved, 'latitude'] = lat[moved]
+        geo.loc[moved, 'longitude'] = lng[moved]
+        geo.loc[moved, 'zona'] = get_zones(lat[moved], lng[moved], zones)
+        punto, distance, point_type = get_starts(65, lat[moved], lng[moved], points_list)
+        geo.loc[moved, 'punto'] = punto
+        geo.loc[moved, 'distance'] = distance
+        geo.loc[moved, 'pointType'] = point_type
+    logging.info('Geo enrichment recomputed {} of {} kicks'.format(moved.sum(), len(moved)))
+
+    geo = geo.astype({'latitude': np.float64, 'longitude': np.float64, 'distance': np.float64})
+    with _geo_lock:
+        _geo_snapshots.pop(key, None)
+        _geo_snapshots[key] = geo
+        #se conservan solo las huellas mas recientes (una por ciudad)
+        while len(_geo_snapshots) > 4:
+            del _geo_snapshots[next(iter(_geo_snapshots))]
+    return geo
+
+def seed_geo(fleet, geo_key):
+    """
+    precarga el enriquecimiento con una corrida guardada (snapshots.latest)
+    solo se usa si la huella del kml y los puntos coincide con la actual
+    """
+    if None in geo_key or not set(geo_columns).issubset(fleet.columns):
+        return
+    geo = fleet[geo_columns].astype({'zona': object, 'punto': object, 'pointType': object})
+    with _geo_lock:
+        _geo_snapshots.setdefault(tuple(geo_key), geo)
+
+ops_statuses = ['free', 'parked', 'running_w_user', 'running_wo_user', 'unavaliable', 'offline']
+#columnas de baja cardinalidad que viajan como categoricas
+category_columns = ['status', 'deviceType', 'booking_type', 'zona', 'punto', 'pointType', 'zoho']
+code_columns = ['trip_status', 'booking_status', 'online']
 
 def kicks_locations(kicks_list, points_list, zones, zoho_response):
+    """
+    kicks_list es el dataframe de get_vehicles o una lista de diccionarios
+    points_list es el indice de puntos retornado por distribution (points_index)
+    zones es el indice de zonas retornado por distribution (zone_index)
+    """
 
-    kicks_df = pd.DataFrame(data=kicks_list, dtype=np.float64)
+    if isinstance(kicks_list, pd.DataFrame):
+        #ingesta columnar de get_vehicles, ya viene tipada
+        kicks_df = kicks_list
+    else:
+        kicks_df = pd.DataFrame(data=kicks_list, dtype=np.float64)
     kicks_df.set_index('id',inplace=True)
 
     #change datetime to Colombia
@@ -20,65 +90,109 @@ def kicks_locations(kicks_list, points_list, zones, zoho_response):
     kicks_df['time_since_booking'] = datetime.now(pytz.timezone('America/Bogota')) - kicks_df['booking_created_at']
 
     #adjust reference_code
-    kicks_df['reference_code'] = kicks_df['reference_code'].map(lambda x: str(x)[2:])
-    
-    kicks_df['zona'] = kicks_df.apply(lambda x: get_zone(x['latitude'], x['longitude'], zones), axis=1)
-    kicks_df['punto'], kicks_df['pointType'] = zip(*kicks_df.apply(lambda x: get_start(65, x['latitude'], x['longitude'], points_list), axis=1))
-
-    if zoho_response[0] == 200:
-        zdict = zoho_response[1]
-
-        def get_zoho_location(kick):
-            if kick in zdict:
-                return zdict[kick]['Ubicacion']
-            else:
-                return 'not in zoho'
-        
-        kicks_df['zoho'] = kicks_df.apply(lambda x: get_zoho_location(x['reference_code']), axis=1)
+    kicks_df['reference_code'] = kicks_df['reference_code'].astype(str).str[2:]
+
+    #codigos y banderas como enteros pequenos, NA cuando no vienen
+    for c in code_columns:
+        kicks_df[c] = pd.to_numeric(kicks_df[c], errors='coerce').astype('Int8')
+
+    geo = geo_enrichment(kicks_df, points_list, zones)
+    for c in ['zona', 'punto', 'distance', 'pointType']:
+        kicks_df[c] = geo[c]
+
+    #203: inventario de zoho desactualizado, se usa pero queda marcado
+    kicks_df['zoho_stale'] = zoho_response[0] == 203
+
+    if zoho_response[0] in [200, 203]:
+        locations = {k: v['Ubicacion'] for k, v in zoho_response[1].items()}
+        kicks_df['zoho'] = kicks_df['reference_code'].map(locations).fillna('not in zoho')
     else:
         kicks_df['zoho'] = 'zoho problem!'
 
-    def ops_status(x):
-        if x['online'] == 0:
-            return 'offline'
-        elif x['trip_status'] == 4:
-            return 'free'
-        elif x['trip_status'] == 1:
-            return 'unavaliable'
-        elif x['trip_status'] == 3:
-            return 'parked'
-        elif x['trip_status'] == 2:
-            if x['booking_status'] == 1:
-                return 'running_w_user'
-            else:
-                return 'running_wo_user'
-
-    kicks_df['ops_status'] = kicks_df.apply(ops_status, axis=1)
+    online = kicks_df['online'].fillna(1).to_numpy(dtype=np.int8)
+    trip = kicks_df['trip_status'].fillna(0).to_numpy(dtype=np.int8)
+    booking = kicks_df['booking_status'].fillna(0).to_numpy(dtype=np.int8)
+    status = np.select([online == 0, trip == 4, trip == 1, trip == 3, (trip == 2) & (booking == 1), trip == 2],
+                       ['offline', 'free', 'unavaliable', 'parked', 'running_w_user', 'running_wo_user'],
+                       default=None)
+    kicks_df['ops_status'] = pd.Categorical(status, categories=ops_statuses)
+
+    for c in category_columns:
+        kicks_df[c] = kicks_df[c].astype('category')
 
     return kicks_df
 
-def kicks_requirements(kicks, distribution):
+
+def report_aggregate(kicks, distribution):
     """
     kicks es un dataframe que viene de kicks_locations
     distribution es un dataframe de puntos de distribucion
+    Una sola pasada agrupada sobre la flota en punto para los dos reportes:
+    points: distribution con el conteo por ops_status y 'activas' (sin unavailable ni running)
+    street: patinetas en calle por zona, de mayor a menor tiempo desde la reserva
+    active: patinetas en punto que cuentan como activas, para el planeador de movimientos
+    """
+    ops = kicks[kicks['zoho'] == 'Punto']
+    active = ~ops['status'].isin(['unavailable', 'running'])
+
+    counts = ops.groupby([ops['punto'], ops['ops_status'], active.rename('activas')],
+                         observed=True, dropna=False).size()
+
+    points = distribution.copy()
+    puntos = distribution.index.get_level_values('punto')
+    by_status = counts.groupby(level=['punto', 'ops_status'], observed=True, dropna=False).sum().unstack(fill_value=0)
+    by_status = by_status.reindex(index=puntos, columns=ops_statuses, fill_value=0).fillna(0)
+    for c in ops_statuses:
+        points[c] = by_status[c].to_numpy()
+    activas = counts[counts.index.get_level_values('activas').to_numpy(dtype=bool)].groupby(level='punto', observed=True).sum()
+    points['activas'] = activas.reindex(puntos).fillna(0).to_numpy()
+
+    street = ops[ops['punto'] == 'en calle'].sort_values(by='time_since_booking', ascending=False)
+    street_active = active.loc[street.index]
+
+    def by_zone(df):
+        return df.groupby('zona', observed=True, sort=False)['reference_code'].agg(list).to_dict()
+
+    return {
+        'points': points,
+        'street': by_zone(street),
+        'street_active': by_zone(street[street_active.to_numpy()]),
+        'zones_op': list(ops['zona'].unique()),
+        'active': ops[active.to_numpy()],
+    }
+
+def _zone_blocks(points, perc, zones, points_header, street_header, street, line):
+    """
+    arma los bloques de texto por zona a partir de las columnas ya agregadas
     """
-    kicks_in_operation = kicks[(kicks['zoho'] == 'Punto') & (kicks['status'] != 'unavailable') & (kicks['status'] != 'running')]
-    streetdf = kicks_in_operation[(kicks_in_operation['punto'] == 'en calle')].sort_values(by='time_since_booking', ascending=False)
+    relocdf = points.assign(Perc_Cap=perc)
+    relocdf.sort_values(['priority', 'Perc_Cap'], ascending=[True, True], inplace=True)
+    relocdf.sort_index(level=0, sort_remaining=False, inplace=True)
 
-    kpp = kicks_in_operation.groupby(by='punto', observed=False).count()['reference_code']
+    present = set(relocdf.index.get_level_values(0))
+    totals = relocdf.groupby(level=0).sum()
+    lines = [line(p, r) for p, r in zip(relocdf.index.get_level_values(1), relocdf.to_dict('records'))]
+    zone_lines = {}
+    for z, l in zip(relocdf.index.get_level_values(0), lines):
+        zone_lines.setdefault(z, []).append(l)
 
-    relocdf = pd.merge(left=kpp, 
-                       right=distribution, 
-                       how='right',
-                       left_index=True, 
-                       right_index=True
-                       )
+    msg = []
+    for zone in zones:
+        if zone in present:
+            msg.append(points_header.format(zone) + line('TOTAL', totals.loc[zone]) + ''.join(zone_lines[zone]))
 
-    relocdf.fillna(0, inplace=True)
+        kicks_on_street = street.get(zone, [])
+        msg.append(street_header.format(zone, len(kicks_on_street)) + '\n'.join(kicks_on_street))
+    return msg
 
-    relocdf['Perc_Cap'] = relocdf['reference_code'] / relocdf['req']
-    relocdf.sort_values(['priority', 'Perc_Cap'], ascending=[True, True], inplace=True)
-    relocdf.sort_index(level=0, sort_remaining=False,inplace=True)
+def kicks_requirements(kicks, distribution, aggregate=None):
+    """
+    kicks es un dataframe que viene de kicks_locations
+    distribution es un dataframe de puntos de distribucion
+    aggregate es el resultado de report_aggregate si ya fue calculado
+    """
+    aggregate = aggregate if aggregate is not None else report_aggregate(kicks, distribution)
+    points = aggregate['points']
 
     def deviation(capacity, kicks):
         n = capacity - kicks
@@ -87,103 +201,33 @@ def kicks_requirements(kicks, distribution):
         else:
             return 'sobran %d' % abs(n)
     
-    def lineText(point, df):
-        kicks = df['reference_code']
-        cap = df['req']
+    def lineText(point, row):
+        kicks = row['activas']
+        cap = row['req']
         return '<b>{0}</b>\nCap: {1:.0f} - hay {2:.0f} 🛴 - {3}\n'.format(point, cap, kicks, deviation(int(cap), kicks))
 
-    msg = []
-
-    zones = sorted(relocdf.index.levels[0].unique())
+    zones = sorted(distribution.index.levels[0].unique())
 
-    for zone in zones:
+    return _zone_blocks(points, points['activas'] / points['req'], zones,
+                        '<b>🛴 por punto en {}</b>\n', '<b>🛴 en calle en {0}: {1}</b>\n',
+                        aggregate['street_active'], lineText)
 
-        #patinetas por punto
-        points_text = '<b>🛴 por punto en {}</b>\n'.format(zone)
-        resumen = relocdf.loc[zone].sum()
-        points_text += lineText('TOTAL', resumen)
-
-        for point ,row in relocdf.loc[zone].iterrows():
-            points_text += lineText(point, row) 
-        msg.append(points_text)
-       
-        #patinetas en calle
-        kicks_on_street = streetdf[streetdf['zona'] == zone]['reference_code'].tolist()
-        street_text = '<b>🛴 en calle en {0}: {1}</b>\n'.format(zone, len(kicks_on_street))
-        street_text += '\n'.join(kicks_on_street)
-        msg.append(street_text)
-    
-    return msg
-
-def kicks_relocation(kicks, distribution):
+def kicks_relocation(kicks, distribution, aggregate=None):
     """
     kicks es un dataframe que viene de kicks_locations
     distribution es un dataframe de puntos de distribucion
+    aggregate es el resultado de report_aggregate si ya fue calculado
     """
-    kicks_in_operation = kicks[kicks['zoho'] == 'Punto']
-    streetdf = kicks_in_operation[(kicks_in_operation['punto'] == 'en calle')].sort_values(by='time_since_booking', ascending=False)
-    
-    grouped = pd.pivot_table(
-        kicks_in_operation, 
-        values='reference_code',
-        index=['punto'],
-        columns=['ops_status'],
-        aggfunc='count',
-        fill_value=0
-    )
-
-    relocdf = pd.merge(left=grouped, 
-                       right=distribution, 
-                       how='right',
-                       left_index=True, 
-                       right_index=True
-                       )
-
-    relocdf.fillna(0, inplace=True)
-
-    relocdf['Perc_Cap'] = relocdf['free'] / relocdf['req']
-    relocdf.sort_values(['priority', 'Perc_Cap'], ascending=[True, True], inplace=True)
-    relocdf.sort_index(level=0, sort_remaining=False,inplace=True)
-
-    def lineText(point, serie):
-        def _checker(colname, s):
-            if colname in s:
-                return s[colname]
-            else:
-                return 0
-        return '<b>{0}</b>\nCap: {1:.0f}, F: {2:.0f}, P: {3:.0f}, R-: {4:.0f}, ND: {5:.0f}, O: {6:.0f}\n'.format(
-            point, 
-            _checker('req', serie), 
-            _checker('free', serie),
-            _checker('parked', serie),
-            _checker('running_wo_user', serie),
-            _checker('unavaliable', serie),
-            _checker('offline', serie)
-        )
+    aggregate = aggregate if aggregate is not None else report_aggregate(kicks, distribution)
+    points = aggregate['points']
 
-    msg = []
+    def lineText(point, row):
+        return '<b>{0}</b>\nCap: {1:.0f}, F: {2:.0f}, P: {3:.0f}, R-: {4:.0f}, ND: {5:.0f}, O: {6:.0f}\n'.format(
+            point, row['req'], row['free'], row['parked'], row['running_wo_user'], row['unavaliable'], row['offline'])
 
     zones_partners = list(distribution.index.levels[0].unique())
-    zones_op = list(kicks_in_operation['zona'].unique())
-    zones = sorted(set(zones_partners + zones_op))
-
-    for zone in zones:
-        if zone in relocdf.index:
-            #patinetas por punto
-            points_text = '<b>🛴 por punto en {}</b>\n'.format(zone)
-            resumen = relocdf.loc[zone].sum()
-            points_text += lineText('TOTAL', resumen)
-
-            for point ,row in relocdf.loc[zone].iterrows():
-                points_text += lineText(point, row) 
-            msg.append(points_text)
-
-        #patinetas en calle
-        kicks_on_street = streetdf[streetdf['zona'] == zone]['reference_code'].tolist()
-        street_text = '<b>🛴 en calle {0}: {1}</b>\n'.format(zone, len(kicks_on_street))
-        street_text += '\n'.join(kicks_on_street)
-        msg.append(street_text)
-
-    return msg
-
+    zones = sorted(set(zones_partners + aggregate['zones_op']))
 
+    return _zone_blocks(points, points['free'] / points['req'], zones,
+                        '<b>🛴 por punto en {}</b>\n', '<b>🛴 en calle {0}: {1}</b>\n',
+                        aggregate['street'], lineText)
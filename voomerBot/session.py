@@ -0,0 +1,70 @@
+import voomerBot.httpmodel as toHire_model
+from os import environ
+from time import monotonic
+import simplejson as json
+import threading
+import logging
+try:
+    import voomerBot.movo_model as movo_model
+except ImportError:
+    movo_model = None
+
+token_ttl = int(environ.get('TOKEN_TTL', '3600'))
+token_refresh = int(environ.get('TOKEN_REFRESH', '300'))
+regions_ttl = int(environ.get('REGIONS_TTL', '86400'))
+#shortname -> siteid cuando no esta el cliente de movo, SITE_IDS='{"bog": 1}'
+site_ids_env = environ.get('SITE_IDS', '{}')
+
+_lock = threading.Lock()
+_tokens = {}
+_regions = {}
+
+
+def get_token(user, password, refresh=False):
+    '''Bearer token for user, shared by the whole process.
+    Logs in again TOKEN_REFRESH seconds before TOKEN_TTL runs out.
+    Returns [status, token]'''
+    with _lock:
+        cached = _tokens.get(user)
+        if not refresh and cached is not None and monotonic() < cached[1] - token_refresh:
+            return [200, cached[0]]
+        token = toHire_model.login(user, password)
+        if token[0] == 200:
+            _tokens[user] = [token[1], monotonic() + token_ttl]
+        else:
+            _tokens.pop(user, None)
+        return token
+
+
+def site_ids():
+    '''Memoized shortname -> siteid map, from movo_model or SITE_IDS when
+    that module is not installed. Returns [status, map]'''
+    with _lock:
+        if 'map' in _regions and monotonic() < _regions['expires']:
+            return [200, _regions['map']]
+        if movo_model is None:
+            _regions['map'] = json.loads(site_ids_env)
+            _regions['expires'] = float('inf')
+            return [200, _regions['map']]
+        regions = movo_model.get_regions()
+        if regions[0] == 200:
+            _regions['map'] = {region['shortname']:region['siteid'] for region in regions[1]}
+            _regions['expires'] = monotonic() + regions_ttl
+            return [200, _regions['map']]
+        return regions
+
+
+def authorized(user, password, query):
+    '''Runs query(token) with the cached token.
+    On a 401 the token is renewed and the query retried once.'''
+    token = get_token(user, password)
+    if token[0] != 200:
+        return token
+    r = query(token[1])
+    if r[0] == 401:
+        logging.warning('Token rejected, logging in again')
+        token = get_token(user, password, refresh=True)
+        if token[0] != 200:
+            return token
+        r = query(token[1])
+    return r
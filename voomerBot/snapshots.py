@@ -0,0 +1,138 @@
+from contextlib import closing
+from time import time
+import pandas as pd
+import numpy as np
+import sqlite3
+import logging
+import os
+
+#base sqlite donde se guarda cada corrida, vacio desactiva el almacenamiento
+snapshot_db = os.environ.get('SNAPSHOT_DB', 'snapshots.sqlite')
+#dias de corridas que se conservan por ciudad, 0 las conserva todas
+keep_days = float(os.environ.get('SNAPSHOT_KEEP_DAYS', '30'))
+
+fleet_columns = {'reference_code': 'TEXT', 'status': 'TEXT', 'ops_status': 'TEXT', 'zoho': 'TEXT',
+    'zona': 'TEXT', 'punto': 'TEXT', 'pointType': 'TEXT', 'latitude': 'REAL', 'longitude': 'REAL',
+    'distance': 'REAL', 'total_percentage': 'REAL', 'trip_status': 'INTEGER', 'online': 'INTEGER'}
+category_columns = ['status', 'ops_status', 'zoho', 'zona', 'punto', 'pointType']
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY, city TEXT, taken_at REAL,
+    zones_key TEXT, points_key TEXT);
+CREATE INDEX IF NOT EXISTS runs_city ON runs (city, taken_at);
+CREATE TABLE IF NOT EXISTS fleet (run_id INTEGER, id INTEGER, {});
+CREATE INDEX IF NOT EXISTS fleet_run ON fleet (run_id);
+CREATE INDEX IF NOT EXISTS fleet_id ON fleet (id, run_id);
+CREATE INDEX IF NOT EXISTS fleet_punto ON fleet (punto, run_id);
+CREATE TABLE IF NOT EXISTS points (run_id INTEGER, zona TEXT, punto TEXT, req REAL,
+    priority REAL, ops_status TEXT, kicks INTEGER);
+CREATE INDEX IF NOT EXISTS points_run ON points (run_id);
+'''.format(', '.join('{} {}'.format(k, v) for k, v in fleet_columns.items()))
+
+
+def _connect():
+    conn = sqlite3.connect(snapshot_db)
+    conn.executescript(_schema)
+    return conn
+
+
+def _compact(df):
+    for c in [c for c in category_columns if c in df]:
+        df[c] = df[c].astype('category')
+    return df
+
+
+def points_table(kicks, distribution):
+    '''Kicks in operation per point and ops_status, with the point demand.
+    Points without kicks keep one row with ops_status None and 0 kicks.'''
+    in_operation = kicks[kicks['zoho'] == 'Punto']
+    counts = in_operation.groupby(['punto', 'ops_status'], observed=True).size().rename('kicks').reset_index()
+    points = distribution[['req', 'priority']].reset_index()
+    table = pd.merge(left=points, right=counts, how='left', on='punto')
+    table['kicks'] = table['kicks'].fillna(0).astype(np.int64)
+    return table[['zona', 'punto', 'req', 'priority', 'ops_status', 'kicks']]
+
+
+def _prune(conn, city, now):
+    '''Deletes the runs of city older than SNAPSHOT_KEEP_DAYS with their rows.'''
+    if not keep_days:
+        return
+    old = '(SELECT run_id FROM runs WHERE city = ? AND taken_at < ?)'
+    params = (city, now - keep_days * 86400)
+    conn.execute('DELETE FROM fleet WHERE run_id IN ' + old, params)
+    conn.execute('DELETE FROM points WHERE run_id IN ' + old, params)
+    conn.execute('DELETE FROM runs WHERE city = ? AND taken_at < ?', params)
+
+
+def save(city, kicks, distribution, geo_key=(None, None)):
+    '''Stores the enriched fleet frame and the per point table of a run,
+    dropping the runs of city older than SNAPSHOT_KEEP_DAYS.
+    Returns the run id, None when the store is disabled or fails.'''
+    if not snapshot_db:
+        return None
+    fleet = kicks[[c for c in fleet_columns if c in kicks]].copy()
+    for c in ['trip_status', 'online']:
+        if c in fleet:
+            fleet[c] = fleet[c].astype('Int64')
+    try:
+        with closing(_connect()) as conn, conn:
+            now = time()
+            _prune(conn, city, now)
+            cur = conn.execute('INSERT INTO runs (city, taken_at, zones_key, points_key) VALUES (?, ?, ?, ?)',
+                               (city, now, geo_key[0], geo_key[1]))
+            run_id = cur.lastrowid
+            fleet.insert(0, 'run_id', run_id)
+            fleet.reset_index().rename(columns={'index': 'id'}).to_sql('fleet', conn, if_exists='append', index=False)
+            table = points_table(kicks, distribution)
+            table.insert(0, 'run_id', run_id)
+            table.to_sql('points', conn, if_exists='append', index=False)
+        return run_id
+    except (sqlite3.Error, ValueError) as err:
+        logging.warning('Snapshot save error {}'.format(err))
+
+
+def latest(city):
+    '''Latest stored run of city as {'taken_at', 'geo_key', 'fleet', 'points'},
+    None if there is none or the store can not be read.'''
+    if not snapshot_db:
+        return None
+    try:
+        with closing(_connect()) as conn:
+            run = conn.execute('SELECT run_id, taken_at, zones_key, points_key FROM runs WHERE city = ? '
+                               'ORDER BY taken_at DESC LIMIT 1', (city,)).fetchone()
+            if run is None:
+                return None
+            fleet = pd.read_sql_query('SELECT * FROM fleet WHERE run_id = ?', conn, params=(run[0],), index_col='id')
+            points = pd.read_sql_query('SELECT * FROM points WHERE run_id = ?', conn, params=(run[0],))
+    except (sqlite3.Error, pd.errors.DatabaseError) as err:
+        #el arranque en caliente es opcional, sin la base se arranca en frio
+        logging.warning('Snapshot load error {}'.format(err))
+        return None
+    return {'taken_at': pd.to_datetime(run[1], unit='s', utc=True), 'geo_key': (run[2], run[3]),
+            'fleet': _compact(fleet.drop(columns='run_id')), 'points': _compact(points.drop(columns='run_id'))}
+
+
+def history(city, start=None, end=None, vehicle=None, punto=None):
+    '''Stored fleet rows of city between start and end (datetimes or epoch
+    seconds), optionally for one vehicle id or one point.'''
+    query = ('SELECT r.taken_at, f.* FROM fleet f JOIN runs r ON r.run_id = f.run_id '
+             'WHERE r.city = ? AND r.taken_at BETWEEN ? AND ?')
+    params = [city, _epoch(start, 0), _epoch(end, time())]
+    if vehicle is not None:
+        query += ' AND f.id = ?'
+        params.append(int(vehicle))
+    if punto is not None:
+        query += ' AND f.punto = ?'
+        params.append(punto)
+    with closing(_connect()) as conn:
+        df = pd.read_sql_query(query + ' ORDER BY r.taken_at', conn, params=params)
+    df['taken_at'] = pd.to_datetime(df['taken_at'], unit='s', utc=True).dt.tz_convert('America/Bogota')
+    return _compact(df.drop(columns='run_id'))
+
+
+def _epoch(t, default):
+    if t is None:
+        return default
+    if isinstance(t, (int, float)):
+        return float(t)
+    return pd.Timestamp(t).timestamp()
@@ -0,0 +1,69 @@
+from voomerBot.metrics import IMPORT_SECONDS
+from time import monotonic
+from os import environ
+import importlib
+import threading
+import logging
+
+_started = monotonic()
+
+#eager: importa todo antes del webhook, background: despues del webhook en un hilo,
+#lazy: en la primera revision
+warm_mode = environ.get('STARTUP_WARM', 'background')
+#segundos de arranque en frio que se consideran aceptables, 0 no revisa
+startup_budget = float(environ.get('STARTUP_BUDGET', '0'))
+
+#dependencias pesadas en el orden en que se importan, cada una se cobra lo que
+#no hayan importado las anteriores
+heavy_modules = ['numpy', 'pandas', 'shapely', 'gspread', 'oauth2client.service_account', 'keytree',
+                 'aiohttp', 'scipy.optimize', 'voomerBot.utils', 'voomerBot.relocator', 'voomerBot.snapshots',
+                 'voomerBot.vehicle_kicker', 'voomerBot.pipeline', 'voomerBot.planner']
+
+_timings = {}
+_lock = threading.Lock()
+
+
+def elapsed():
+    '''Seconds since the process started loading the app.'''
+    return monotonic() - _started
+
+
+def load(name):
+    '''Imports name once, timing it. Returns the module.'''
+    if name in _timings:
+        return importlib.import_module(name)
+    with _lock:
+        start = monotonic()
+        module = importlib.import_module(name)
+        if name not in _timings:
+            _timings[name] = monotonic() - start
+            IMPORT_SECONDS.labels(name).set(_timings[name])
+    return module
+
+
+def warm(names=heavy_modules):
+    '''Imports every heavy module, logging the ones that fail.'''
+    for name in names:
+        try:
+            load(name)
+        except ImportError as err:
+            logging.warning('Startup import of {} failed {}'.format(name, err))
+
+
+def report():
+    '''Logs the import time of each heavy module, slowest first,
+    and warns when the cold start went over STARTUP_BUDGET.'''
+    total = sum(_timings.values())
+    lines = ['{:<32} {:>7.3f}s'.format(k, v) for k, v in sorted(_timings.items(), key=lambda x: -x[1])]
+    logging.info('Startup imports ({}) {:.3f}s, {:.3f}s since start\n{}'.format(warm_mode, total, elapsed(),
+                                                                               '\n'.join(lines)))
+    if startup_budget and total > startup_budget:
+        logging.warning('Startup imports took {:.3f}s, over the {:.3f}s budget'.format(total, startup_budget))
+    return dict(_timings)
+
+
+if __name__ == '__main__':
+    #python -m voomerBot.startup mide el arranque en frio sin levantar el bot
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s]-[%(levelname)s] %(message)s')
+    warm()
+    report()
@@ -1,32 +1,22 @@
-import collections
+import hashlib
 import xml.etree.ElementTree as ET
 import keytree
+import shapely
 from shapely.geometry import shape, Point
-import math
-from functools import reduce
+from shapely.strtree import STRtree
 import requests
 import simplejson as json
 import os
 from simplejson.errors import JSONDecodeError
-from time import sleep
+from time import sleep, monotonic
 import logging
+import threading
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 import pandas as pd
 import numpy as np
-from datetime import time, datetime
-import pytz
-
-def flatten(d, parent_key='', sep='_'):
-    items = []
-    for k, v in d.items():
-        new_key = parent_key + sep + k if parent_key else k
-        if isinstance(v, collections.MutableMapping):
-            items.extend(flatten(v, new_key, sep=sep).items())
-        else:
-            items.append((new_key, v))
-    return dict(items)
-
+from datetime import datetime
+from voomerBot.metrics import RETRIES, upstream
 
 #parseador de kmls para poligonos y puntos
 def kmlparser(kml_string, shape_type='Polygon'):
@@ -43,50 +33,78 @@ def kmlparser(kml_string, shape_type='Polygon'):
         geofences[name.text] = shape(keytree.geometry(shapes))
     return geofences
 
-#definir si un punto esta en una determinada zona de operación
-def get_zone(lat, lng, geozone):
-    #trae la zona de operación segun los poligonos almacenados en geo zone
-    coord = Point(lng, lat)
-    for loc, pol in geozone.items():
-        if pol.contains(coord):
-            return loc
-    return 'Sin zona'
-
-
-#distancia en metros entre 2 coordenadas
-def distance(lat1, lng1, lat2, lng2):
-    def deg2rad(deg):
-        return deg * math.pi / 180
-    
-    R = 6371
-    dLat = deg2rad(lat2 - lat1)
-    dLng = deg2rad(lng2 - lng1)
-    
-    a = math.pow(math.sin(dLat/2), 2) + math.cos(deg2rad(lat1)) * math.cos(deg2rad(lat2)) * math.pow(math.sin(dLng/2), 2)
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))    
-    d = R * c
-    return d * 1000
-
-def get_start(limit ,lat, lng, aliados, hot_spots=None):
-    #compara la distancia entre el punto y todos los aliados y lo compara contra el limite
-    #aliados es un diccionario nombre, punto aliado
-    #hot_spots es un dicciomario nombre; poligono 
-    #cada aliado en aliados es una lista con 2 elementos
-    
-    distances = [[name, distance(lat, lng, point.y, point.x), 'aliado'] for name, point in aliados.items()]
-    
-    if hot_spots is not None:
-        for name, hotspot in hot_spots.items():
-            distances.append([name, distance(lat, lng, hotspot.y, hotspot.x), 'hotzone'])
-
-    closest = reduce(lambda a,b: a if a[1] < b[1] else b, distances)
-    if closest[1] < limit:
-        return closest[0], closest[2]
-    else: 
-        return 'en calle', 'en calle'
-
-
-def zoho():
+def zone_index(geozone):
+    """
+    geozone es un diccionario nombre: poligono retornado por kmlparser
+    Devuelve un indice STRtree sobre los poligonos preparados, se construye una vez por kml
+    """
+    polygons = np.array(list(geozone.values()), dtype=object)
+    shapely.prepare(polygons)
+    #el ultimo nombre es el valor por defecto para puntos sin zona
+    names = np.array(list(geozone.keys()) + ['Sin zona'], dtype=object)
+    #huella del kml, cambia si cambia algun nombre o poligono
+    key = hashlib.sha1(b''.join(n.encode() + p.wkb for n, p in geozone.items())).hexdigest()
+    return {'names': names, 'tree': STRtree(polygons), 'key': key}
+
+def get_zones(lat, lng, zindex):
+    #zona de operacion de cada coordenada, recibe las columnas de latitud y longitud
+    coords = shapely.points(np.asarray(lng, dtype=np.float64), np.asarray(lat, dtype=np.float64))
+    zones = np.full(len(coords), len(zindex['names']) - 1)
+    pts, pols = zindex['tree'].query(coords, predicate='within')
+    #si un punto cae en varios poligonos gana el primero del kml
+    np.minimum.at(zones, pts, pols)
+    return zindex['names'][zones]
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    #distancia en metros entre coordenadas, acepta arreglos
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(x, dtype=np.float64)) for x in (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * 6371 * 1000 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+def points_index(aliados, hot_spots=None):
+    """
+    aliados es un diccionario nombre: Point retornado por distribution_points
+    hot_spots es un diccionario nombre: Point opcional
+    Devuelve las coordenadas de todos los puntos en arreglos, se construye una vez por hoja
+    """
+    hot_spots = hot_spots if hot_spots is not None else {}
+    names = list(aliados.keys()) + list(hot_spots.keys())
+    types = ['aliado'] * len(aliados) + ['hotzone'] * len(hot_spots)
+    coords = [(p.y, p.x) for p in list(aliados.values()) + list(hot_spots.values())]
+    coords = np.array(coords, dtype=np.float64).reshape(-1, 2)
+    lat, lng = np.radians(coords).T
+    #huella de los puntos, cambia si cambia algun nombre, tipo o coordenada
+    key = hashlib.sha1('|'.join(names + types).encode() + coords.tobytes()).hexdigest()
+    return {'names': np.array(names + ['en calle'], dtype=object),
+            'types': np.array(types + ['en calle'], dtype=object),
+            'lat': lat, 'lng': lng, 'key': key}
+
+def get_starts(limit, lat, lng, pindex, chunk=4096):
+    """
+    punto mas cercano de cada coordenada, recibe las columnas de latitud y longitud
+    devuelve tres arreglos: punto mas cercano, distancia en metros y tipo de punto
+    """
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lng = np.radians(np.asarray(lng, dtype=np.float64))
+    closest = np.full(len(lat), len(pindex['names']) - 1)
+    dist = np.full(len(lat), np.inf)
+
+    if len(pindex['lat']) > 0:
+        #la matriz de haversine se calcula por bloques para acotar la memoria
+        for s in range(0, len(lat), chunk):
+            la, ln = lat[s:s + chunk, None], lng[s:s + chunk, None]
+            a = np.sin((pindex['lat'] - la) / 2) ** 2 + np.cos(la) * np.cos(pindex['lat']) * np.sin((pindex['lng'] - ln) / 2) ** 2
+            d = 2 * 6371 * 1000 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+            closest[s:s + chunk] = np.argmin(d, axis=1)
+            dist[s:s + chunk] = d[np.arange(len(d)), closest[s:s + chunk]]
+
+    #fuera del limite (o sin coordenadas) queda en calle
+    closest[~(dist < limit)] = len(pindex['names']) - 1
+    return pindex['names'][closest], dist, pindex['types'][closest]
+
+
+def _zoho_query():
     
     app = os.environ.get('ZOHO_APP_NAME')
     view = os.environ.get('ZOHO_VIEW_NAME')
@@ -94,11 +112,13 @@ def zoho():
     network_retries = int(os.environ.get('NETWORK_RETRIES', '5'))
     network_sleep = int(os.environ.get('NETWORK_SLEEP', '2'))
 
-    url = "https://creator.zoho.com/api/json/{}/view/{}".format(app, view)
+    url = "{}/api/json/{}/view/{}".format(os.environ.get('ZOHO_URL', 'https://creator.zoho.com'), app, view)
 
     for i in range(network_retries):
         try:
-            response = requests.get(url, params=parameters)
+            with upstream('zoho', 'inventory') as call:
+                response = requests.get(url, params=parameters)
+                call['status'] = response.status_code
             if response.status_code == 200:
                 keys = ['Ubicacion', 'Estado']
                 kicks_list = response.json()['Inv_Scan_Scooter']
@@ -112,81 +132,232 @@ def zoho():
                 requests.exceptions.ChunkedEncodingError,
                 UnicodeEncodeError, JSONDecodeError) as err:
             logging.warning('GET query error on zoho {} {}'.format(url, err))
+            RETRIES.labels('zoho', 'inventory').inc()
             sleep(network_sleep**i)
     return [500, ['Internal Error']]
 
+#segundos en que el inventario se considera fresco y maximo tiempo que se sirve sin refrescar
+zoho_ttl = int(os.environ.get('ZOHO_TTL', '300'))
+zoho_max_stale = int(os.environ.get('ZOHO_MAX_STALE', '21600'))
+
+_zoho_lock = threading.Lock()
+_zoho_cache = {'data': None, 'fetched': 0, 'failed': False, 'refreshing': False}
+
+def _zoho_refresh():
+    r = _zoho_query()
+    with _zoho_lock:
+        _zoho_cache['refreshing'] = False
+        if r[0] == 200:
+            _zoho_cache.update({'data': r[1], 'fetched': monotonic(), 'failed': False})
+        else:
+            logging.warning('Zoho refresh failed {}'.format(r[0]))
+            _zoho_cache['failed'] = True
+    return r
+
+def zoho():
+    """
+    inventario de zoho por QR, [200, dict] si esta fresco
+    sirve el ultimo inventario bueno de inmediato mientras se refresca en segundo plano
+    devuelve [203, dict] cuando el inventario esta desactualizado porque zoho fallo
+    pasado ZOHO_MAX_STALE no se sirve el inventario viejo, se devuelve el error de zoho
+    """
+    with _zoho_lock:
+        data = _zoho_cache['data']
+        age = monotonic() - _zoho_cache['fetched']
+        background = data is not None and zoho_ttl <= age < zoho_max_stale
+        if background and not _zoho_cache['refreshing']:
+            _zoho_cache['refreshing'] = True
+            threading.Thread(target=_zoho_refresh, name='zoho-refresh', daemon=True).start()
+
+    if data is None or age >= zoho_max_stale:
+        #sin inventario o demasiado viejo, se espera la consulta y si falla se reporta el error
+        return _zoho_refresh()
+
+    return [203 if _zoho_cache['failed'] else 200, data]
+
+city_src = {
+    'mde': {'wkb': 'Distribución patinetas MDE', 'wks': 'Data MDE'},
+    'bog': {'wkb': 'Distribución patinetas BOG V2', 'wks': 'Data BOG'},
+}
+
+#segundos durante los cuales se confia en la hoja descargada sin consultar su revision
+distribution_ttl = int(os.environ.get('DISTRIBUTION_TTL', '900'))
+
+#'ranges' descarga solo las columnas que usa distribution, 'all' descarga toda la hoja
+sheets_fetch = os.environ.get('SHEETS_FETCH', 'ranges')
+
+#rangos usados por distribution con la fila, columna donde empiezan y su ancho
+sheet_ranges = {
+    'E12': (11, 4, 1),       #kml de zonas
+    'A14:C': (13, 0, 3),     #id, zona y subzona
+    'E14:G': (13, 4, 3),     #punto, lat, lng
+    'T14:AF': (13, 19, 13),  #bloque de prioridad
+    'AR14:BD': (13, 43, 13), #bloque de demanda
+}
+
+_sheets = {}
+_distributions = {}
+#las ciudades corren en hilos paralelos, el lock protege solo el diccionario
+_distributions_lock = threading.Lock()
+
+def _worksheet_values(wks):
+    """
+    devuelve las filas de la hoja con la misma disposicion de get_all_values
+    pidiendo en una sola llamada solo los rangos de sheet_ranges
+    """
+    if sheets_fetch == 'all':
+        return wks.get_all_values()
+
+    ranges = list(sheet_ranges.keys())
+    blocks = wks.batch_get(ranges)
+
+    nrows = max(sheet_ranges[r][0] + len(b) for r, b in zip(ranges, blocks))
+    ncols = max(col0 + width for _, col0, width in sheet_ranges.values())
+    data = [[''] * ncols for _ in range(nrows)]
+
+    for r, block in zip(ranges, blocks):
+        row0, col0, width = sheet_ranges[r]
+        for i, row in enumerate(block):
+            cells = row[:width]
+            data[row0 + i][col0:col0 + len(cells)] = cells
+    return data
+
+def _sheet_revision(sheet):
+    #consulta barata a drive, solo trae la fecha de modificacion del archivo
+    with upstream('sheets', 'revision') as call:
+        r = sheet.client.request('get', 'https://www.googleapis.com/drive/v3/files/{}'.format(sheet.id),
+                                 params={'fields': 'modifiedTime'})
+        call['status'] = r.status_code
+    return r.json()['modifiedTime']
+
+def _sheet_data(city):
+    """
+    devuelve la revision y las filas de la hoja de distribucion de la ciudad
+    solo descarga la hoja cuando vence el ttl y la revision en drive cambio
+    """
+    cached = _sheets.get(city)
+    now = monotonic()
+
+    if cached is not None and now - cached['checked'] < distribution_ttl:
+        return cached['revision'], cached['data']
+
+    if cached is not None and cached.get('sheet') is not None:
+        sheet = cached['sheet']
+    else:
+        scope = ['https://www.googleapis.com/auth/drive']
+        credentials_dict = json.loads(os.environ.get('GOOGLE_API_CREDENTIALS'))
+        credentials = ServiceAccountCredentials.from_json_keyfile_dict(credentials_dict, scope)
+        gc = gspread.authorize(credentials)
+        with upstream('sheets', 'open') as call:
+            sheet = gc.open(city_src[city]['wkb'])
+            call['status'] = 200
+
+    revision = _sheet_revision(sheet)
+    if cached is not None and cached['revision'] == revision:
+        cached.update({'sheet': sheet, 'checked': now})
+        return revision, cached['data']
+
+    with upstream('sheets', 'values') as call:
+        data = _worksheet_values(sheet.worksheet(city_src[city]['wks']))
+        call['status'] = 200
+    _sheets[city] = {'sheet': sheet, 'revision': revision, 'checked': now, 'data': data}
+    return revision, data
+
+def _reloc_row():
+    d = datetime.now().weekday()
+
+    if d in [0,1,2]:
+        d = 0
+    elif d in [3,4]:
+        d = 3
+    elif d == 5:
+        d = 6
+    else:
+        d  = 9
+
+    h = datetime.now().hour
+    if h in range(6,11):
+        h = 1
+    elif h in range(11, 16):
+        h = 2
+    else:
+        h = 3
+
+    return d + h
+
+def _parse_distribution(data, reloc_row, active, geo=None):
+    zonedata = [['Zona ' + r[1][0] + r[2], r[4], r[5], r[6], r[43 + reloc_row], r[19 + reloc_row]] for r in data[13:] if r[0] != '']
+
+    labels = ['zona', 'punto', 'lat', 'lng', 'req', 'priority']
+
+    pointsdf = pd.DataFrame(data=zonedata, 
+                            columns=labels,
+                            dtype=np.float64
+    )
+    
+    pointsdf.set_index(['zona', 'punto'], inplace=True)
+    pointsdf = pointsdf.infer_objects()
+
+    data_dict = {}
+
+    if active == True:
+        data_dict['points'] = pointsdf[pointsdf['req'] > 0]
+    else:
+        data_dict['points'] = pointsdf    
+
+    #el kml no depende de la franja horaria, se reutiliza si ya fue parseado
+    if geo is None:
+        geo = {'map': kmlparser(data[11][4])}
+        geo['zones'] = zone_index(geo['map'])
+    data_dict.update(geo)
+    data_dict['aliados'] = distribution_points(data_dict['points'])
+    data_dict['starts'] = points_index(data_dict['aliados'])
+
+    return data_dict
+
 def distribution(city, active=True):
     """
     devuelve un dataframe con:
     index: zona, punto, lat, lng, dia (L-J, V-S, D)
     values: cantidad de patinetas por punto
+    El resultado se memoriza por revision de la hoja y franja horaria, no se debe modificar
     """
-
-    city_src = {
-        'mde': {'wkb': 'Distribución patinetas MDE', 'wks': 'Data MDE'},
-        'bog': {'wkb': 'Distribución patinetas BOG V2', 'wks': 'Data BOG'},
-    }
-
-    scope = ['https://www.googleapis.com/auth/drive']
-    credentials_dict = json.loads(os.environ.get('GOOGLE_API_CREDENTIALS'))
     network_retries = int(os.environ.get('NETWORK_RETRIES', '5'))
     network_sleep = int(os.environ.get('NETWORK_SLEEP', '2'))
 
     for i in range(network_retries):
         try:
-            credentials = ServiceAccountCredentials.from_json_keyfile_dict(credentials_dict, scope)
-            gc = gspread.authorize(credentials)
-            wks = gc.open(city_src[city]['wkb']).worksheet(city_src[city]['wks'])
-            data = wks.get_all_values()
-
-            d = datetime.now().weekday()
-
-            if d in [0,1,2]:
-                d = 0
-            elif d in [3,4]:
-                d = 3
-            elif d == 5:
-                d = 6
-            else:
-                d  = 9
-
-            h = datetime.now().hour
-            if h in range(6,11):
-                h = 1
-            elif h in range(11, 16):
-                h = 2
-            else:
-                h = 3
-
-            reloc_row = d + h
-
-            zonedata = [['Zona ' + r[1][0] + r[2], r[4], r[5], r[6], r[43 + reloc_row], r[19 + reloc_row]] for r in data[13:] if r[0] != '']
-
-            labels = ['zona', 'punto', 'lat', 'lng', 'req', 'priority']
-
-            pointsdf = pd.DataFrame(data=zonedata, 
-                                    columns=labels,
-                                    dtype=np.float64
-            )
-            
-            pointsdf.set_index(['zona', 'punto'], inplace=True)
-            pointsdf = pointsdf.infer_objects()
-
-            data_dict = {}
-
-            if active == True:
-                data_dict['points'] = pointsdf[pointsdf['req'] > 0]
-            else:
-                data_dict['points'] = pointsdf    
-
-            data_dict['map'] = kmlparser(data[11][4])   
-
-            return data_dict    
-
+            revision, data = _sheet_data(city)
+            break
         except (gspread.exceptions.GSpreadException,
-                gspread.exceptions.APIError) as err:
+                gspread.exceptions.APIError,
+                requests.exceptions.RequestException) as err:
             logging.warning('Google query error {}'.format(err))
+            RETRIES.labels('sheets', 'distribution').inc()
+            if city in _sheets:
+                #se vuelve a autorizar en el siguiente intento
+                _sheets[city]['sheet'] = None
             sleep(network_sleep**i)
+    else:
+        if city not in _sheets:
+            return None
+        logging.warning('Using cached distribution for {}'.format(city))
+        revision, data = _sheets[city]['revision'], _sheets[city]['data']
+
+    key = (city, revision, _reloc_row(), active)
+    with _distributions_lock:
+        parsed = _distributions.get(key)
+        if parsed is None:
+            same_sheet = [v for k, v in _distributions.items() if k[:2] == key[:2]]
+            geo = {k: same_sheet[0][k] for k in ['map', 'zones']} if len(same_sheet) > 0 else None
+    if parsed is None:
+        #el parseo va fuera del lock para no frenar a las otras ciudades
+        parsed = _parse_distribution(data, key[2], active, geo)
+        with _distributions_lock:
+            for k in [k for k in _distributions if k[0] == city and k[1] != revision]:
+                del _distributions[k]
+            parsed = _distributions.setdefault(key, parsed)
+    return parsed
 
 def distribution_points(pointsfd):
     """
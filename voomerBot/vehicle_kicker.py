@@ -1,5 +1,5 @@
-import voomerBot.toHire_model as toHire_model
-import voomerBot.movo_model as movo_model
+import voomerBot.httpmodel as toHire_model
+import voomerBot.session as session
 import codecs
 import simplejson as json
 import csv
@@ -12,9 +12,10 @@ import pandas as pd
 
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s]-[%(levelname)s] %(message)s')
 
-def kicks_change_state(kicks_list, usr_action):
-
-    region = 'bog'
+def kicks_change_state(kicks_list, usr_action, region='bog'):
+    '''Runs usr_action over kicks_list.
+    Returns [status, results], results has one entry per id that got an answer,
+    a 401 that survived the token refresh stays as that id's result.'''
 
     try:
         f = os.environ.get('MOVO_CREDENTIALS')
@@ -28,9 +29,9 @@ def kicks_change_state(kicks_list, usr_action):
         sys.exit()
 
     try:
-        regions = movo_model.get_regions()
+        regions = session.site_ids()
         if regions[0] == 200:
-            siteIds = {region['shortname']:region['siteid'] for region in regions[1]}
+            siteIds = regions[1]
         else:
             logging.error('Couldn\'t load MOVO regions')
             sys.exit()
@@ -39,56 +40,91 @@ def kicks_change_state(kicks_list, usr_action):
         logging.error('Couldn\'t load MOVO regions2')
         sys.exit()
 
-    token = toHire_model.login(cfg.get('user'), cfg.get('password'))
-    
     #async def process_kicks(list_kicks):
     #    rsp = await asyncio.gather(*(toHire_model.action(token[1], usr_action, id, siteIds.get(region), 'kick') for id in list_kicks))
     #    return rsp
-    
+
+    results = {}
+
+    def process_kicks(token):
+        #en el reintento de session.authorized solo se reenvian las rechazadas por el token
+        pending = [id for id in kicks_list if id not in results or results[id]['status'] == 401]
+        rsp = asyncio.run(toHire_model.action2(token, usr_action, pending, siteIds.get(region), 'kick'))
+        for x in rsp:
+            results[x['id']] = x
+        rsp = [results[id] for id in kicks_list if id in results]
+        return [401 if any(x['status'] == 401 for x in rsp) else 200, rsp]
+
     logging.info(f"started at {time.strftime('%X')}")
-    aiorsp = asyncio.run(toHire_model.action2(token[1], usr_action, kicks_list, siteIds.get(region), 'kick'))
+    aiorsp = session.authorized(cfg.get('user'), cfg.get('password'), process_kicks)
     logging.info(f"finished at {time.strftime('%X')}")
 
-    return aiorsp
+    #se devuelve lo que se alcanzo a ejecutar aunque el barrido haya fallado
+    if aiorsp[0] != 200:
+        logging.error('Couldn\'t change kicks state {}'.format(aiorsp[0]))
+    return [aiorsp[0], [results[id] for id in kicks_list if id in results]]
 
-def check_kicks(kicks):
+#segundos tras los cuales una patineta sana se vuelve a probar
+probe_window = int(os.environ.get('PROBE_WINDOW', '10800'))
 
-    kicks_to_check = kicks[(kicks['zoho'] == 'Punto') & (kicks['ops_status'] == 'free')]
+#ultimo resultado del stop por patineta: hora, estado http, tipo de error
+_health = {}
+#patinetas libres en punto en la corrida anterior de cada ciudad
+_free_before = {}
 
-    ids = kicks_to_check.index.tolist()
-
-    states = kicks_change_state(ids, 'stop')
+def probe_due(id, now, free_before):
+    #se prueba si nunca se probo, fallo, acaba de quedar libre o vencio la ventana
+    record = _health.get(id)
+    return (record is None or record['error'] is not None or id not in free_before
+            or now - record['probed'] >= probe_window)
 
-    def get_info(msg):
-        if msg['status'] == False:
-            return 'Revisar, ' + msg['error']['type']
-        else:
-            return 'Ok' 
+def check_kicks(kicks, region='bog'):
 
-    labels = ['id', 'status_request', 'rsp']
+    kicks_to_check = kicks[(kicks['zoho'] == 'Punto') & (kicks['ops_status'] == 'free')]
 
-    statesdf = pd.DataFrame(states, columns=labels)
-    statesdf.set_index('id', inplace=True)
+    ids = kicks_to_check.index.tolist()
+    now = time.time()
+    free_before = _free_before.get(region, set())
+    due = [id for id in ids if probe_due(id, now, free_before)]
+    logging.info('Probing {} of {} free kicks'.format(len(due), len(ids)))
+
+    status, states = kicks_change_state(due, 'stop', region)
+
+    def get_info(state):
+        #el cuerpo puede no traer status ni error (p. ej. un 502 del proxy), se usa el estado http
+        msg = state['rsp']
+        if not isinstance(msg, dict):
+            return 'respuesta invalida'
+        if msg.get('status', state['status'] == 200) == False:
+            error = msg.get('error')
+            if isinstance(error, dict) and 'type' in error:
+                return error['type']
+            return 'HTTP {}'.format(state['status'])
+        return None
+
+    for state in states:
+        _health[state['id']] = {'probed': now, 'status': state['status'], 'error': get_info(state)}
+    _free_before[region] = set(ids)
+
+    #se reportan todas las que siguen con error, se hayan probado en esta corrida o no
+    labels = ['probed', 'status', 'error']
+
+    healthdf = pd.DataFrame([_health.get(id, {}) for id in ids], columns=labels, index=kicks_to_check.index)
+    healthdf.rename(columns={'status': 'status_request'}, inplace=True)
 
     checkeddf = pd.merge(left=kicks_to_check, 
-                         right=statesdf, 
+                         right=healthdf, 
                          how='left',
                          left_index=True, 
                          right_index=True
     )
 
-    checkeddf['msg'] = checkeddf.apply(lambda x: get_info(x['rsp']), axis=1)
-
-    msg =''
+    review = checkeddf[checkeddf['error'].notna()]
+    msg = ''.join(review['reference_code'] + ' Revisar, ' + review['error'] + '\n')
 
-    for _ ,row in checkeddf[checkeddf['msg'] != 'Ok'].iterrows():
-        msg = msg + row['reference_code'] + ' ' + row['msg'] + '\n'
+    #un barrido fallido no puede verse igual que una flota sana
+    unanswered = len(due) - len(states)
+    if unanswered > 0:
+        msg = '<b>Barrido fallido ({}): {} patinetas sin probar</b>\n'.format(status, unanswered) + msg
 
     return msg
-
-
-
-
-
-
-
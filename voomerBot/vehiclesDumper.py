@@ -1,6 +1,8 @@
-import voomerBot.toHire_model as toHire_model
-import voomerBot.movo_model as movo_model
-from voomerBot.utils import flatten
+import voomerBot.httpmodel as toHire_model
+import voomerBot.session as session
+from array import array
+import numpy as np
+import pandas as pd
 import codecs
 import simplejson as json
 import csv
@@ -15,6 +17,11 @@ keys = ['id', 'latitude', 'longitude', 'reference_code', 'status',
     'updated_at', 'booking_id', 'booking_status', 'booking_type',
     'booking_UserId', 'booking_created_at', 'online']
 
+def fleet_frame(columns):
+    #los buffers tipados se pasan a numpy sin copiar
+    return pd.DataFrame({k: np.frombuffer(columns[k], dtype=columns[k].typecode)
+                            if isinstance(columns[k], array) else columns[k] for k in keys})
+
 def get_vehicles(region):
     try:
         f = os.environ.get('CREDENTIALS')
@@ -28,9 +35,9 @@ def get_vehicles(region):
         sys.exit()
 
     try:
-        regions = movo_model.get_regions()
+        regions = session.site_ids()
         if regions[0] == 200:
-            siteIds = {region['shortname']:region['siteid'] for region in regions[1]}
+            siteIds = regions[1]
         else:
             logging.error('Couldn\'t load regions')
             sys.exit()
@@ -39,18 +46,12 @@ def get_vehicles(region):
         logging.error('Couldn\'t load regions2')
         sys.exit()
 
-    def process(vehicles):
-        return ({k:v for k,v in flatten(vehicle).items() if k in keys} for vehicle in vehicles)
-
     logging.info('Welcome to Vehicle Proc')
 
-    token = toHire_model.login(cfg.get('user'), cfg.get('password'))
-    if token[0] == 200:
-        r = toHire_model.vehicle(token[1], siteIds.get(region))
-        if r[0] == 200:
-            return list(process(r[1]))
-        else:
-            logging.error('Vehicle HTTP status not OK')
+    r = session.authorized(cfg.get('user'), cfg.get('password'),
+                           lambda token: toHire_model.vehicle_columns(token, siteIds.get(region)))
+    if r[0] == 200:
+        return fleet_frame(r[1])
     else:
-        logging.error('Couldn\'t log-in')
+        logging.error('Vehicle HTTP status not OK {}'.format(r[0]))
     logging.info('Terminating Vehicle Proc')
\ No newline at end of file